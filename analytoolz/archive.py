@@ -0,0 +1,181 @@
+"""
+Archive whole UA views to a Parquet dataset partitioned by view, report and date
+
+    archiver = Archiver(ga3, 'archive/', [
+        {'name': 'pages', 'dimensions': ['date', 'pagePath'], 'metrics': ['pageviews', 'entrances']},
+        {'name': 'sources', 'dimensions': ['date', 'source', 'medium'], 'metrics': ['sessions']},
+    ])
+    archiver.run(['123456', '234567'], '2016-01-01', '2023-06-30')
+
+Each day of each report is fetched separately without sampling and written to
+view=<id>/report=<name>/date=<YYYY-MM-DD>/. Finished days are appended to a manifest log
+(a JSON line for each day), so an interrupted run resumes from the days not archived yet.
+"""
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Optional
+import json
+import logging
+import os
+import threading
+
+from . import errors, utils
+
+pa = utils.lazy_import('pyarrow')
+pq = utils.lazy_import('pyarrow.parquet')
+ds = utils.lazy_import('pyarrow.dataset')
+
+LOGGER = logging.getLogger(__name__)
+
+MANIFEST_FILE = '_manifest.jsonl'
+
+
+class Archiver(object):
+    """Fetch reports of UA views day by day and write them to a Hive-partitioned Parquet dataset
+
+    Args:
+        ga3: MegatonUA with credentials
+        path (str): root directory of the dataset
+        reports (list): report definitions with name, dimensions and metrics.
+            dimension_filter, metric_filter and segments are used if given.
+        concurrency (int): number of days to fetch at the same time
+        workers (int): number of batchGet calls to run at the same time for each day
+        checkpoint_dir (str): save pages of days in progress to this directory to resume within a day
+    """
+
+    def __init__(self, ga3, path: str, reports: list, concurrency: int = 4, workers: int = 2,
+                 checkpoint_dir: Optional[str] = None):
+        """constructor"""
+        for r in reports:
+            if not r.get('name') or not r.get('dimensions') or not r.get('metrics'):
+                raise errors.BadRequest("Each report needs name, dimensions and metrics.")
+        self.ga3 = ga3
+        self.path = path
+        self.reports = reports
+        self.concurrency = max(1, concurrency)
+        self.workers = workers
+        self.checkpoint_dir = checkpoint_dir
+        self.manifest_file = os.path.join(path, MANIFEST_FILE)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+        self.manifest = self._read_manifest()
+        if self.manifest:
+            LOGGER.info(f"Resuming archive in {path} ({len(self.manifest)} days done)")
+
+    @staticmethod
+    def _key(view_id: str, name: str, day: str):
+        return f"{view_id}/{name}/{day}"
+
+    def _read_manifest(self) -> dict:
+        """Return days recorded in the manifest log. A line cut off by a crash is ignored."""
+        manifest = {}
+        if not os.path.isfile(self.manifest_file):
+            return manifest
+        line = ''
+        with open(self.manifest_file, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                    manifest[entry.pop('key')] = entry
+                except (ValueError, KeyError):
+                    LOGGER.warning(f"ignoring a broken line in {self.manifest_file}")
+        if line and not line.endswith('\n'):
+            # start the next record on a new line
+            with open(self.manifest_file, 'a') as f:
+                f.write('\n')
+        return manifest
+
+    def _record(self, key: str, **kwargs):
+        """Append a finished day to the manifest log"""
+        line = json.dumps(dict(kwargs, key=key), ensure_ascii=False)
+        with self._lock:
+            self.manifest[key] = kwargs
+            with open(self.manifest_file, 'a') as f:
+                f.write(f"{line}\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+    def done(self, view_id: str, name: str, day: str) -> bool:
+        """Return True if the day of the report has been archived"""
+        return self._key(view_id, name, day) in self.manifest
+
+    def _get_report(self):
+        """Return a Report for the current thread, since a Report keeps state of the request in progress"""
+        if not hasattr(self._local, 'report'):
+            self._local.report = self.ga3.Report(self.ga3)
+        return self._local.report
+
+    def _archive_day(self, view_id: str, report: dict, day: str):
+        """Fetch a day of a report and write it to its partition"""
+        r = self._get_report()
+        df = r.show(
+            report['dimensions'],
+            report['metrics'],
+            start_date=day,
+            end_date=day,
+            dimension_filter=report.get('dimension_filter'),
+            metric_filter=report.get('metric_filter'),
+            segments=report.get('segments'),
+            limit=report.get('limit', 100000),
+            workers=self.workers,
+            unsampled=True,
+            checkpoint_dir=self.checkpoint_dir,
+        )
+        directory = os.path.join(self.path, f"view={view_id}", f"report={report['name']}", f"date={day}")
+        if df is not None and len(df):
+            # the date is given by the partition
+            df = utils.change_column_type(df.drop(columns=['date'], errors='ignore'))
+            os.makedirs(directory, exist_ok=True)
+            tmp_file = os.path.join(directory, '.part-0.parquet.tmp')
+            pq.write_table(pa.Table.from_pandas(df, preserve_index=False), tmp_file)
+            os.replace(tmp_file, os.path.join(directory, 'part-0.parquet'))
+        rows = 0 if df is None else len(df)
+        self._record(self._key(view_id, report['name'], day), rows=rows, sampled=bool(r.sampled_ranges))
+        LOGGER.debug(f"{view_id} {report['name']} {day}: {rows} rows")
+        return rows
+
+    def run(self, views: list, start_date: str, end_date: str):
+        """Archive all reports of the views for each day in the range
+
+        Returns:
+            dict of rows archived in this run for each view and report
+        Raises:
+            errors.IncompleteReport: when some days failed. The other days are archived first, and the rows
+                archived for each view and report are kept in the exception. A rerun fetches the failed days.
+        """
+        days = utils.get_date_range(utils.resolve_date(start_date), utils.resolve_date(end_date))
+        summary = {}
+        failed = {}
+        for view_id in views:
+            view_id = str(view_id)
+            self.ga3.view.id = view_id
+            for report in self.reports:
+                todo = [d for d in days if not self.done(view_id, report['name'], d)]
+                LOGGER.info(f"Archiving {report['name']} of view {view_id}: "
+                            f"{len(todo)} of {len(days)} days to fetch")
+                rows = 0
+                with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                    futures = {executor.submit(self._archive_day, view_id, report, d): d for d in todo}
+                    for future in as_completed(futures):
+                        key = self._key(view_id, report['name'], futures[future])
+                        try:
+                            rows += future.result()
+                        except Exception as e:
+                            LOGGER.error(f"{key} failed: {e!r}")
+                            failed[key] = e
+                summary[f"{view_id}/{report['name']}"] = rows
+        sampled = [k for k, v in self.manifest.items() if v.get('sampled')]
+        if sampled:
+            LOGGER.warning(f"Sampled data remains in {len(sampled)} days: {sampled[:10]}")
+        if failed:
+            first = min(failed)
+            raise errors.IncompleteReport(
+                f"{len(failed)} days failed: {sorted(failed)[:10]}. {failed[first]!r}",
+                data=[[k, v] for k, v in summary.items()], headers=['report', 'rows']) from failed[first]
+        return summary
+
+    def dataset(self):
+        """Return the archive as pyarrow.dataset.Dataset"""
+        return ds.dataset(self.path, format='parquet', partitioning='hive', ignore_prefixes=['_', '.'])
@@ -2,14 +2,63 @@
 Functions for Google Cloud BigQuery
 """
 
-from typing import Dict, List
+from typing import Dict, List, Optional
 import re
 import sys
 
-from google.api_core.exceptions import PermissionDenied
-from google.cloud import bigquery
-from google.cloud import bigquery_datatransfer
-from google.cloud.exceptions import NotFound
+from . import errors, spill, utils
+
+# heavy client libraries are imported when BigQuery is first used
+api_exceptions = utils.lazy_import('google.api_core.exceptions')
+bigquery = utils.lazy_import('google.cloud.bigquery')
+bigquery_datatransfer = utils.lazy_import('google.cloud.bigquery_datatransfer')
+
+
+def _event_param(key: str, table: str = 'event_params'):
+    """SQL expression to get a parameter value as a string from the GA4 export"""
+    return (f"(SELECT COALESCE(value.string_value, CAST(value.int_value AS STRING), "
+            f"CAST(COALESCE(value.double_value, value.float_value) AS STRING)) "
+            f"FROM UNNEST({table}) WHERE key = '{key}')")
+
+
+_SESSION_KEY = f"CONCAT(user_pseudo_id, '.', {_event_param('ga_session_id')})"
+
+# GA4 Data API dimensions as SQL expressions on the GA4 export (events_YYYYMMDD)
+GA4_EXPORT_DIMENSIONS = {
+    'date': "event_date",
+    'eventName': "event_name",
+    'pageLocation': _event_param('page_location'),
+    'pagePath': f"REGEXP_EXTRACT({_event_param('page_location')}, r'^[a-z]+://[^/]+([^?#]*)')",
+    'pageTitle': _event_param('page_title'),
+    'pageReferrer': _event_param('page_referrer'),
+    'hostName': "device.web_info.hostname",
+    'platform': "platform",
+    'streamId': "stream_id",
+    'deviceCategory': "device.category",
+    'operatingSystem': "device.operating_system",
+    'browser': "device.web_info.browser",
+    'language': "device.language",
+    'country': "geo.country",
+    'region': "geo.region",
+    'city': "geo.city",
+    'firstUserSource': "traffic_source.source",
+    'firstUserMedium': "traffic_source.medium",
+    'firstUserCampaignName': "traffic_source.name",
+}
+
+# GA4 Data API metrics as SQL aggregations on the GA4 export
+GA4_EXPORT_METRICS = {
+    'eventCount': "COUNT(1)",
+    'totalUsers': "COUNT(DISTINCT user_pseudo_id)",
+    'activeUsers': "COUNT(DISTINCT IF(is_active_user, user_pseudo_id, NULL))",
+    'newUsers': "COUNT(DISTINCT IF(event_name IN ('first_visit', 'first_open'), user_pseudo_id, NULL))",
+    'sessions': f"COUNT(DISTINCT {_SESSION_KEY})",
+    'engagedSessions': f"COUNT(DISTINCT IF({_event_param('session_engaged')} = '1', {_SESSION_KEY}, NULL))",
+    'screenPageViews': "COUNTIF(event_name IN ('page_view', 'screen_view'))",
+    'userEngagementDuration': f"CAST(SUM(CAST({_event_param('engagement_time_msec')} AS INT64)) / 1000 AS INT64)",
+    'transactions': "COUNTIF(event_name = 'purchase')",
+    'purchaseRevenue': "SUM(ecommerce.purchase_revenue)",
+}
 
 
 class Megaton:
@@ -43,16 +92,47 @@ class Megaton:
         else:
             print(f"project {self.id} does not have any datasets.")
 
-    def run(self, query: str):
+    def run(self, query: str, to_parquet: Optional[str] = None, memory_budget: Optional[int] = None,
+            partition_cols: Optional[list] = None, overwrite: bool = False):
         """Run a SQL query and return data
         Args:
             query (str):
                 SQL query to be executed.
+            to_parquet (str): write the result to a Parquet dataset in this directory page by page
+                and return a pyarrow dataset instead of the rows
+            memory_budget (int): bytes of rows to keep in memory before writing them
+            partition_cols (list): columns to partition the Parquet dataset by
+            overwrite (bool): allow to_parquet to be a directory with files, replacing Parquet files
+                of an earlier run in it
         """
         job = self.client.query(query=query)
         results = job.result()  # Waits for job to complete.
+        if to_parquet:
+            writer = spill.ParquetSpill(to_parquet, memory_budget=memory_budget, partition_cols=partition_cols,
+                                        overwrite=overwrite)
+            return self.stream(results, writer).close()
         return results
 
+    def stream(self, results: 'bigquery.table.RowIterator', writer: spill.ParquetSpill):
+        """Write query results to a ParquetSpill a page at a time"""
+        for df in results.to_dataframe_iterable():
+            writer.append_df(df)
+        return writer
+
+    def load_dataframe(self, df, table_id: str, mode: str = 'a'):
+        """Load a dataframe into a table
+        Args:
+            df (DataFrame): data to load
+            table_id (str): table in dataset.table format. Created if missing.
+            mode (str): 'a' to append or 'w' to overwrite
+        """
+        job_config = bigquery.LoadJobConfig(
+            write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE if mode == 'w'
+            else bigquery.WriteDisposition.WRITE_APPEND
+        )
+        job = self.client.load_table_from_dataframe(df, table_id, job_config=job_config)
+        return job.result()  # Waits for job to complete.
+
     class Dataset:
         def __init__(self, parent):
             self.parent = parent
@@ -84,7 +164,7 @@ class Megaton:
                 self.instance = dataset
                 self.ref = dataset.reference
                 self.id = id
-            except NotFound as e:
+            except api_exceptions.NotFound as e:
                 if 'Not found: Dataset' in str(e):
                     print(f"Dataset {dataset_id} is not found in the project {self.parent.id}")
                 return False
@@ -135,7 +215,7 @@ class Megaton:
             else:
                 print("Please select a dataset first.")
 
-        def create(self, table_id: str, schema: bigquery.SchemaField, description: str = '', partitioning_field: str = '',
+        def create(self, table_id: str, schema: 'bigquery.SchemaField', description: str = '', partitioning_field: str = '',
                    clustering_fields: list = []):
             dataset_ref = self.parent.dataset.ref
             table_ref = dataset_ref.table(table_id)
@@ -169,6 +249,113 @@ class Megaton:
             self.clustering_fields = ['client_id', 'event_name']
             self.clean_table_id = 'clean'
 
+        def _format_date(self, value: str):
+            """Convert a date of the GA4 Data API such as 'yesterday' or '7daysAgo' to YYYYMMDD"""
+            return utils.resolve_date(value).strftime('%Y%m%d')
+
+        def _get_field(self, name: str, fields: Dict):
+            """Return SQL expression for a dimension or a metric of the GA4 Data API"""
+            if name in fields:
+                return fields[name]
+            if name.startswith('customEvent:'):
+                return _event_param(name.split(':', 1)[1])
+            if name.startswith('customUser:'):
+                return _event_param(name.split(':', 1)[1], 'user_properties')
+            raise errors.BadRequest(f"{name} is not supported with BigQuery. Pass its SQL expression in fields.")
+
+        def _format_condition(self, expression: str, operator: str, value: str, numeric: bool = False):
+            """Convert a filter condition of Core Reporting API v3 format to SQL
+            Args:
+                numeric (bool): compare the value as a number, as for metrics, instead of a string
+            """
+            if numeric and operator in ['==', '!=']:
+                return f"{expression} {'=' if operator == '==' else '!='} {float(value)}"
+            quoted = "'" + value.replace('\\', '\\\\').replace("'", "\\'") + "'"
+            is_not = 'NOT ' if operator.startswith('!') else ''
+            if operator in ['==', '!=']:
+                return f"{is_not}{expression} = {quoted}"
+            elif operator in ['=@', '!@']:
+                return f"{is_not}STRPOS({expression}, {quoted}) > 0"
+            elif operator in ['=~', '!~']:
+                return f"{is_not}REGEXP_CONTAINS({expression}, {quoted})"
+            elif operator in ['>', '>=', '<', '<=']:
+                return f"{expression} {operator} {float(value)}"
+            raise errors.BadRequest(f"Invalid operator: '{operator}'")
+
+        def get_query_for_report(
+                self,
+                dimensions: list,
+                metrics: list,
+                date1: str,
+                date2: str,
+                dimension_filter: Optional[list] = None,
+                metric_filter: Optional[list] = None,
+                order_bys: Optional[str] = None,
+                limit: Optional[int] = None,
+                table: str = 'events_*',
+                fields: Optional[Dict] = None,
+        ):
+            """Return a query to aggregate the GA4 export like a report of the GA4 Data API
+            Args:
+                dimensions (list): api_name of dimensions
+                metrics (list): api_name of metrics
+                date1 (str): start date in YYYY-MM-DD format or 'NdaysAgo'
+                date2 (str): end date
+                dimension_filter (list): conditions as (api_name, operator, value)
+                metric_filter (list): conditions as (api_name, operator, value)
+                order_bys (str): api_names separated by comma. '-' prefix to sort descending.
+                limit (int): max number of rows
+                table (str): 'events_*' for the raw export. Other tables such as the clean table
+                    need to be partitioned on 'date' and have their columns defined in fields.
+                fields (dict): SQL expression for each api_name, used instead of the defaults
+            """
+            fields = dict(GA4_EXPORT_DIMENSIONS, **GA4_EXPORT_METRICS, **(fields or {}))
+            dataset = self.parent.dataset.id
+            date1, date2 = self._format_date(date1), self._format_date(date2)
+
+            select = [f"{self._get_field(d, fields)} AS {d.replace(':', '_')}" for d in dimensions]
+            select += [f"{self._get_field(m, fields)} AS {m}" for m in metrics]
+
+            if table.endswith('*'):
+                where = [f"_TABLE_SUFFIX BETWEEN '{date1}' AND '{date2}'"]
+            else:
+                where = [f"date BETWEEN PARSE_DATE('%Y%m%d', '{date1}') AND PARSE_DATE('%Y%m%d', '{date2}')"]
+            where += [self._format_condition(self._get_field(f, fields), o, v) for f, o, v in dimension_filter or []]
+            having = [self._format_condition(self._get_field(f, fields), o, v, numeric=True)
+                      for f, o, v in metric_filter or []]
+
+            query = "SELECT\n    " + ",\n    ".join(select)
+            query += f"\nFROM `{dataset}.{table}`"
+            query += "\nWHERE " + "\n    AND ".join(where)
+            if dimensions:
+                query += "\nGROUP BY " + ", ".join(str(i + 1) for i in range(len(dimensions)))
+            if having:
+                query += "\nHAVING " + "\n    AND ".join(having)
+            if order_bys:
+                orders = [f"{o.lstrip('-').replace(':', '_')}{' DESC' if o.startswith('-') else ''}"
+                          for o in order_bys.split(',')]
+                query += "\nORDER BY " + ", ".join(orders)
+            if limit:
+                query += f"\nLIMIT {int(limit)}"
+            return query
+
+        def run_report(self, dimensions: list, metrics: list, date1: str, date2: str,
+                       writer: Optional[spill.ParquetSpill] = None, **kwargs):
+            """Aggregate the GA4 export like a report of the GA4 Data API and return a DataFrame
+            with a column for each dimension and metric. Other arguments are the same as get_query_for_report.
+
+            Values can differ from the Data API because the API applies thresholds and estimates unique counts.
+
+            Args:
+                writer (ParquetSpill): write the result page by page to it instead of returning a DataFrame
+            """
+            sql = self.get_query_for_report(dimensions, metrics, date1, date2, **kwargs)
+            if writer:
+                return self.parent.stream(self.parent.run(sql), writer)
+            df = self.parent.run(sql).to_dataframe()
+            df.columns = dimensions + metrics
+            return df
+
         def get_first_date_recorded(self):
             partitions = [t for t in self.parent.dataset.tables if t.startswith('events_')]
             if partitions:
@@ -186,7 +373,7 @@ class Megaton:
                 clustering_fields=self.clustering_fields
             )
 
-        def dict_to_bq_schema(self, schema: Dict) -> List[bigquery.SchemaField]:
+        def dict_to_bq_schema(self, schema: Dict) -> List['bigquery.SchemaField']:
             """Converts a dictionary to list of bigquery.SchemaField
             for use with bigquery client library.
             Dict must contain name and type keys.
@@ -356,7 +543,7 @@ END IF;"""
                 response = self.parent.dts_client.create_transfer_config(request=request)
                 print(f"Schedule query was created: {response.name}")
                 return response
-            except PermissionDenied as e:
+            except api_exceptions.PermissionDenied as e:
                 print("権限がありません。")
                 m = re.search(r'reason: "([^"]+)', str(sys.exc_info()[1]))
                 if m:
@@ -0,0 +1,88 @@
+"""
+Disk-backed cache with expiration
+"""
+
+from typing import Optional
+import hashlib
+import logging
+import os
+import pickle
+import threading
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+
+class DiskCache(object):
+    """Key-value store kept in memory and optionally persisted to a directory.
+
+    Args:
+        path (str): directory to save entries. Entries are kept only in memory if omitted.
+        ttl (int): seconds until an entry expires. Entries never expire if None.
+    """
+
+    def __init__(self, path: Optional[str] = None, ttl: Optional[int] = 86400):
+        """constructor"""
+        self.path = path
+        self.ttl = ttl
+        self._memo = {}
+        self._lock = threading.Lock()
+        if path and not os.path.isdir(path):
+            os.makedirs(path, exist_ok=True)
+
+    def _filename(self, key: str):
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.path, f"{digest}.pkl")
+
+    def _is_fresh(self, saved_time: float):
+        return self.ttl is None or time.time() - saved_time < self.ttl
+
+    def get(self, key: str, default=None):
+        """Return the value for the key if it exists and has not expired"""
+        with self._lock:
+            entry = self._memo.get(key)
+        if entry is None and self.path:
+            try:
+                with open(self._filename(key), 'rb') as f:
+                    entry = pickle.load(f)
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                LOGGER.debug(f"ignoring broken cache entry for {key}: {e}")
+        if entry and self._is_fresh(entry[0]):
+            with self._lock:
+                self._memo[key] = entry
+            return entry[1]
+        return default
+
+    def set(self, key: str, value):
+        """Save the value for the key"""
+        entry = (time.time(), value)
+        with self._lock:
+            self._memo[key] = entry
+        if self.path:
+            filename = self._filename(key)
+            tmp_file = f"{filename}.{os.getpid()}.{threading.get_ident()}.tmp"
+            try:
+                with open(tmp_file, 'wb') as f:
+                    pickle.dump(entry, f)
+                os.replace(tmp_file, filename)
+            except Exception as e:
+                LOGGER.warning(f"failed to save cache entry for {key}: {e}")
+        return value
+
+    def delete(self, key: str):
+        """Remove the entry for the key"""
+        with self._lock:
+            self._memo.pop(key, None)
+        if self.path and os.path.isfile(self._filename(key)):
+            os.remove(self._filename(key))
+
+    def clear(self):
+        """Remove all entries"""
+        with self._lock:
+            self._memo.clear()
+        if self.path and os.path.isdir(self.path):
+            for file in os.listdir(self.path):
+                if file.endswith('.pkl'):
+                    os.remove(os.path.join(self.path, file))
@@ -0,0 +1,111 @@
+"""
+Checkpoints to resume long report fetches
+"""
+
+from datetime import date
+from typing import Optional
+import hashlib
+import json
+import logging
+import os
+import pickle
+import re
+import shutil
+import threading
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Checkpoint(object):
+    """Pages of a report saved to a directory with a manifest, so that a rerun of the same request
+    can skip the pages already fetched.
+
+    Args:
+        path (str): checkpoint directory. Each request gets its own subdirectory.
+        request (str): text identifying the request, such as the serialized request body
+        dates (list): dates of the request. Relative dates like 'yesterday' make the checkpoint valid only today.
+    """
+
+    def __init__(self, path: str, request: str, dates: Optional[list] = None):
+        """constructor"""
+        if any(d and not re.match(r'^\d{4}-\d{2}-\d{2}$', str(d)) for d in dates or []):
+            request += f"@{date.today()}"
+        self.id = hashlib.sha1(request.encode('utf-8')).hexdigest()[:16]
+        self.dir = os.path.join(path, self.id)
+        self.manifest_file = os.path.join(self.dir, 'manifest.json')
+        self._lock = threading.Lock()
+        os.makedirs(self.dir, exist_ok=True)
+
+        self.manifest = None
+        if os.path.isfile(self.manifest_file):
+            try:
+                with open(self.manifest_file, 'r') as f:
+                    self.manifest = json.load(f)
+            except ValueError:
+                LOGGER.warning(f"ignoring broken manifest {self.manifest_file}")
+        if not self.manifest:
+            self.manifest = {'request': request, 'info': {}, 'pages': {}, 'complete': False}
+        elif self.manifest['pages']:
+            LOGGER.info(f"Resuming from checkpoint {self.dir} ({len(self.manifest['pages'])} pages saved)")
+
+    @property
+    def info(self):
+        """Values shared by all pages such as headers and total rows"""
+        return self.manifest['info']
+
+    @property
+    def complete(self):
+        return self.manifest['complete']
+
+    def _page_file(self, page_id: str):
+        name = re.sub(r'[^\w\-]', '_', str(page_id))
+        return os.path.join(self.dir, f"page_{name}.pkl")
+
+    def _write_manifest(self):
+        tmp_file = f"{self.manifest_file}.tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump(self.manifest, f, ensure_ascii=False, indent=1, default=str)
+        os.replace(tmp_file, self.manifest_file)
+
+    def has(self, page_id) -> bool:
+        """Return True if the page has been saved"""
+        return str(page_id) in self.manifest['pages']
+
+    def page(self, page_id) -> dict:
+        """Return the manifest entry of a saved page"""
+        return self.manifest['pages'].get(str(page_id))
+
+    def pages(self) -> list:
+        """Return ids of saved pages in the order they were saved"""
+        return list(self.manifest['pages'].keys())
+
+    def load(self, page_id):
+        """Return data of a saved page"""
+        with open(self._page_file(page_id), 'rb') as f:
+            return pickle.load(f)
+
+    def save(self, page_id, data, **kwargs):
+        """Save data of a page. Keyword arguments are recorded for the page in the manifest."""
+        file = self._page_file(page_id)
+        with open(f"{file}.tmp", 'wb') as f:
+            pickle.dump(data, f)
+        os.replace(f"{file}.tmp", file)
+        with self._lock:
+            self.manifest['pages'][str(page_id)] = dict(kwargs, file=os.path.basename(file), rows=len(data))
+            self._write_manifest()
+
+    def update(self, **kwargs):
+        """Record values shared by all pages in the manifest"""
+        with self._lock:
+            self.manifest['info'].update(kwargs)
+            self._write_manifest()
+
+    def finish(self):
+        """Mark all pages as fetched"""
+        with self._lock:
+            self.manifest['complete'] = True
+            self._write_manifest()
+
+    def clear(self):
+        """Delete all saved pages"""
+        shutil.rmtree(self.dir, ignore_errors=True)
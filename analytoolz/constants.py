@@ -10,6 +10,15 @@ DEFAULT_SCOPES = [
     'https://www.googleapis.com/auth/cloud-platform',
 ]
 
+# Default API calls per second for each Google API, shared by all threads using the same project
+API_RATE_LIMITS = {
+    'analytics': 10,
+    'analyticsreporting': 10,
+}
+
+# Maximum number of date ranges in a GA4 report request
+GA4_MAX_DATE_RANGES = 4
+
 # URL of Google Sheets template for GA4
 GOOGLE_SHEET_GA4_TEMPLATE_URL = 'https://docs.google.com/spreadsheets/d/1Jr4au61Xy7gfGBf5yvNKdT43awsSv98zOs4FTfM6Nms'
 
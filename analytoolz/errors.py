@@ -76,8 +76,36 @@ class PartialDataReturned(Error):
         super().__init__(self.message)
 
 
+class SampledData(Error):
+    """Data returned from API is sampled"""
+
+    def __init__(self, message=None):
+        self.message = message or "The report data is sampled."
+        super().__init__(self.message)
+
+
 class SheetNotFound(Error):
     """Sheet specified is not found in the workbook"""
 
     def __init__(self, message=None):
         self.message = message or "The sheet requested is not found."
+
+
+class DeadlineExceeded(Error):
+    """The time allowed for the task has run out"""
+
+    def __init__(self, message=None):
+        self.message = message or "The deadline has been exceeded."
+        super().__init__(self.message)
+
+
+class IncompleteReport(Error):
+    """Report data could not be fetched completely.
+    Rows fetched before the failure are kept in `data` with `headers` and `types`."""
+
+    def __init__(self, message=None, data=None, headers=None, types=None):
+        self.message = message or "Only a part of the report data was fetched."
+        self.data = data or []
+        self.headers = headers
+        self.types = types
+        super().__init__(self.message)
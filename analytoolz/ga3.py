@@ -2,20 +2,30 @@
 Functions for Google Analytics 3 (Universal Analytics) API
 """
 
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from typing import Optional
 import json
 import logging
+import numpy as np
+import operator
 import pandas as pd
 import re
 import sys
 
-from googleapiclient import errors as err
 from google.oauth2.credentials import Credentials
 
-from . import constants, errors, ga4, google_api, utils
+from . import checkpoint, constants, errors, ga4, google_api, utils
+
+err = utils.lazy_import('googleapiclient.errors')
 
 LOGGER = logging.getLogger(__name__)
 
+# Maximum number of requests in a batchGet of Analytics Reporting API v4
+BATCH_SIZE = 5
+
+# Calls of Management API sent in a batch request
+MANAGEMENT_BATCH_SIZE = 30
+
 
 class MegatonUA(ga4.MegatonGA4):
     this = "Megaton UA"
@@ -25,23 +35,112 @@ class MegatonUA(ga4.MegatonGA4):
         self.view = self.View(self)
 
     def build_client(self):
-        self.data_client = google_api.GoogleApi(
-            "analyticsreporting",
-            "v4",
-            constants.DEFAULT_SCOPES,
-            credentials=self.credentials,
-            credential_cache_file=self.credential_cache_file)
+        self.data_client = self._build_data_client()
         self.admin_client = google_api.GoogleApi(
             "analytics",
             "v3",
             constants.DEFAULT_SCOPES,
             credentials=self.credentials,
-            credential_cache_file=self.credential_cache_file)
+            credential_cache_file=self.credential_cache_file,
+            rate_limiter=self.rate_limiter,
+            timeout=self.channel_options.timeout if self.channel_options else None)
+
+    def _build_data_client(self):
+        """Return a new client of Analytics Reporting API.
+        A client can be shared by threads, since it keeps a service for each thread."""
+        return google_api.GoogleApi(
+            "analyticsreporting",
+            "v4",
+            constants.DEFAULT_SCOPES,
+            credentials=self.credentials,
+            credential_cache_file=self.credential_cache_file,
+            rate_limiter=self.rate_limiter,
+            timeout=self.channel_options.timeout if self.channel_options else None)
+
+    def inventory(self, property_ids: Optional[list] = None, goals: bool = True,
+                  batch_size: int = MANAGEMENT_BATCH_SIZE):
+        """Collect properties, views, custom definitions and goals of all accessible accounts
+        Calls of Management API are sent together in batch requests, followed by remaining pages of large lists.
+        Args:
+            property_ids (list): properties to collect. All accessible properties if omitted.
+            goals (bool): include goals of views
+            batch_size (int): calls in a batch request
+        Returns:
+            dict of DataFrames: properties, views, custom_dimensions, custom_metrics, goals and errors
+        """
+        api = self.admin_client
+        management = api.service.management()
+        page_size = 1000
+        accounts = self.accounts or []
+        tables = {k: [] for k in ['properties', 'views', 'custom_dimensions', 'custom_metrics', 'goals', 'errors']}
+
+        def collect(requests: dict):
+            """Execute list calls of (resource, params) in batches, then remaining pages of them by start_index"""
+            def build(resource, params, **kwargs):
+                return getattr(management, resource)().list(max_results=page_size, **params, **kwargs)
+
+            results = api.execute_batch({k: build(*v) for k, v in requests.items()}, batch_size)
+            pages = {}
+            for key, response in results.items():
+                if isinstance(response, Exception):
+                    tables['errors'].append({'id': key[1], 'item': key[0], 'error': repr(response)})
+                    results[key] = {}
+                else:
+                    for start in google_api.next_page_indexes(response):
+                        pages[key + (start,)] = build(*requests[key], start_index=start)
+            if pages:
+                LOGGER.debug(f"requesting {len(pages)} more pages")
+            for (*key, start), response in sorted(api.execute_batch(pages, batch_size).items()):
+                key = tuple(key)
+                if isinstance(response, Exception):
+                    tables['errors'].append({'id': key[1], 'item': key[0], 'error': f"page {start}: {response!r}"})
+                else:
+                    results[key]['items'] += response.get('items', [])
+            return results
+
+        # properties, views and goals can be listed for all properties of an account at once
+        requests = {}
+        for a in accounts:
+            requests[('properties', a['id'])] = ('webproperties', {'accountId': a['id']})
+            requests[('views', a['id'])] = ('profiles', {'accountId': a['id'], 'webPropertyId': '~all'})
+            if goals:
+                requests[('goals', a['id'])] = ('goals', {
+                    'accountId': a['id'], 'webPropertyId': '~all', 'profileId': '~all'})
+        LOGGER.info(f"Collecting properties of {len(accounts)} accounts...")
+        results = collect(requests)
+
+        properties = {}
+        for a in accounts:
+            for i in results[('properties', a['id'])].get('items', []):
+                if not property_ids or i['id'] in [str(p) for p in property_ids]:
+                    properties[i['id']] = a['id']
+                    tables['properties'].append({'account_id': a['id'], **_parse_property(i)})
+            for i in results[('views', a['id'])].get('items', []):
+                if i['webPropertyId'] in properties:
+                    tables['views'].append(_parse_view(i))
+            for i in results.get(('goals', a['id']), {}).get('items', []):
+                if i['webPropertyId'] in properties:
+                    tables['goals'].append({'property_id': i['webPropertyId'], 'view_id': i['profileId'],
+                                            **_parse_goal(i)})
+
+        requests = {}
+        for property_id, account_id in properties.items():
+            params = {'accountId': account_id, 'webPropertyId': property_id}
+            requests[('custom_dimensions', property_id)] = ('customDimensions', params)
+            requests[('custom_metrics', property_id)] = ('customMetrics', params)
+        LOGGER.info(f"Collecting custom definitions of {len(properties)} properties...")
+        for (item, property_id), response in collect(requests).items():
+            parse = _parse_custom_dimension if item == 'custom_dimensions' else _parse_custom_metric
+            for i in response.get('items', []):
+                tables[item].append({'property_id': property_id, **parse(i)})
+        LOGGER.info("...done")
+
+        return {k: pd.DataFrame(v) for k, v in tables.items()}
 
     def _update(self):
         """Returns account summaries accessible by the caller."""
         try:
-            response = self.admin_client.management().accountSummaries().list().execute()
+            response = self.admin_client.list_all('management.accountSummaries')
         except err.HttpError as e:
             if e.resp.status == 403:
                 LOGGER.error(f"GCPのプロジェクトでGoogle Analytics APIを有効化してください。")
@@ -71,39 +170,16 @@ class MegatonUA(ga4.MegatonGA4):
 
     class Account(ga4.MegatonGA4.Account):
         def _update(self):
-            response = self.parent.admin_client.management().webproperties().list(
-                accountId=self.id).execute()
-            results = []
-            for i in response.get('items', []):
-                dict = {
-                    'id': i['id'],
-                    'name': i['name'],
-                    'industry': i.get('industryVertical', ''),
-                    'service_level': i['level'],
-                    'created_time': i['created'],
-                    'updated_time': i['updated'],
-                    'data_retention': i['dataRetentionTtl'],
-                    'data_retention_reset_on_activity': i['dataRetentionResetOnNewActivity'],
-                    'properties': '',
-                }
-                results.append(dict)
+            response = self.parent.admin_client.list_all('management.webproperties', accountId=self.id)
+            results = [_parse_property(i) for i in response.get('items', [])]
             self.properties = results
             return results
 
         @property
         def segments(self):
             """Returns built-in and custom segments for the account."""
-            response = self.parent.admin_client.management().segments().list().execute()
-            results = []
-            for i in response.get('items', []):
-                dict = {
-                    'id': i['id'],
-                    'name': i['name'],
-                    'type': i['type'],
-                    'definition': i['definition'],
-                }
-                results.append(dict)
-            return results
+            response = self.parent.admin_client.list_all('management.segments')
+            return [_parse_segment(i) for i in response.get('items', [])]
 
     class Property(ga4.MegatonGA4.Property):
         def __init__(self, parent):
@@ -119,38 +195,21 @@ class MegatonUA(ga4.MegatonGA4):
 
         def _get_custom_dimensions(self):
             """Returns custom dimensions for the property."""
-            response = self.parent.admin_client.management().customDimensions().list(
+            response = self.parent.admin_client.list_all(
+                'management.customDimensions',
                 accountId=self.parent.account.id,
                 webPropertyId=self.id
-            ).execute()
-            results = []
-            for i in response.get('items', []):
-                dict = {
-                    'index': i['index'],
-                    'display_name': i['name'],
-                    'scope': i['scope'],
-                    'active': i['active'],
-                }
-                results.append(dict)
-            return results
+            )
+            return [_parse_custom_dimension(i) for i in response.get('items', [])]
 
         def _get_custom_metrics(self):
             """Returns custom metrics for the property."""
-            response = self.parent.admin_client.management().customMetrics().list(
+            response = self.parent.admin_client.list_all(
+                'management.customMetrics',
                 accountId=self.parent.account.id,
                 webPropertyId=self.parent.property.id
-            ).execute()
-            results = []
-            for i in response.get('items', []):
-                dict = {
-                    'index': i['index'],
-                    'display_name': i['name'],
-                    'scope': i['scope'],
-                    'type': i['type'],
-                    'active': i['active'],
-                }
-                results.append(dict)
-            return results
+            )
+            return [_parse_custom_metric(i) for i in response.get('items', [])]
 
         def _update(self):
             self._clear()
@@ -158,28 +217,12 @@ class MegatonUA(ga4.MegatonGA4):
             # self.get_available()  # Metadata API is not implemented
 
             # get views
-            response = self.parent.admin_client.management().profiles().list(
+            response = self.parent.admin_client.list_all(
+                'management.profiles',
                 accountId=self.parent.account.id,
                 webPropertyId=self.parent.property.id
-            ).execute()
-            results = []
-            for i in response.get('items', []):
-                dict = {
-                    'property_id': i['webPropertyId'],
-                    'id': i['id'],
-                    'name': i['name'],
-                    'currency': i['currency'],
-                    'time_zone': i['timezone'],
-                    'url': i['websiteUrl'],
-                    'type': i['type'],
-                    'ecommerce': i['eCommerceTracking'],
-                    'bot_filtering': i.get('botFilteringEnabled', False),
-                    'site_search_parameters': i.get('siteSearchQueryParameters', ''),
-                    'default_page': i.get('defaultPage', ''),
-                    'created_time': i['created'],
-                    'updated_time': i['updated'],
-                }
-                results.append(dict)
+            )
+            results = [_parse_view(i) for i in response.get('items', [])]
             self.views = results
             # return results
 
@@ -272,28 +315,13 @@ class MegatonUA(ga4.MegatonGA4):
         @property
         def goals(self):
             """Get Goals"""
-            response = self.parent.admin_client.management().goals().list(
+            response = self.parent.admin_client.list_all(
+                'management.goals',
                 accountId=self.parent.account.id,
                 webPropertyId=self.parent.property.id,
                 profileId=self.id
-            ).execute()
-            results = []
-            for i in response.get('items', []):
-                dict = {
-                    'id': i.get('id'),
-                    'name': i.get('name'),
-                    'value': i.get('value'),
-                    'type': i.get('type'),
-                    'url_destination': i.get('urlDestinationDetails'),
-                    'time_on_site': i.get('visitTimeOnSiteDetails'),
-                    'pages_per_session': i.get('visitNumPagesDetails'),
-                    'event': i.get('eventDetails'),
-                    'created_time': i.get('created'),
-                    'updated_time': i.get('updated'),
-                    'active': i.get('active'),
-                }
-                results.append(dict)
-            return results
+            )
+            return [_parse_goal(i) for i in response.get('items', [])]
 
         def show(self, me: str = 'info', index_col: Optional[str] = None):
             res = None
@@ -444,38 +472,28 @@ class MegatonUA(ga4.MegatonGA4):
             }
 
         def _parse_response(self, report: dict):
-            all_data = []
-            names = []
-            dimension_types = []
-            metric_types = []
-
-            for i in report['columnHeader']['dimensions']:
-                names.append(i.replace('ga:', ''))
-                dimension_types.append('category')
-
-            for i in report['columnHeader']['metricHeader']['metricHeaderEntries']:
-                names.append(i['name'])
-                metric_types.append(i['type'])
-
-            for row in report['data'].get('rows', []):
-                row_data = []
-                for d in row['dimensions']:
-                    row_data.append(d)
-                for d in row['metrics']:
-                    for i, v in enumerate(d['values']):
-                        row_data.append(self._convert_metric(v, metric_types[i]))
-                all_data.append(row_data)
-
-            return all_data, names, dimension_types + metric_types
-
-        def _request_report_api(self, offset: str, request: dict):
-            if offset:
-                request["pageToken"] = offset
+            """Return data of a report as a DataFrame, headers and types"""
+            return decode_report(report)
+
+        def _request_report_api(self, offset: str, request: dict, unsampled: bool = False):
+            return self._request_pages_api([offset], request, unsampled)[0]
+
+        def _request_pages_api(self, tokens: list, request: dict, unsampled: bool = False):
+            """Request pages of a report in a single batchGet
+            Args:
+                tokens (list): page tokens. Up to 5 pages can be requested at once.
+                unsampled (bool): raise SampledData instead of returning sampled data
+            Returns:
+                list of data, total rows, headers, types and next page token for each page
+            """
+            requests = []
+            for token in tokens:
+                requests.append(dict(request, pageToken=token) if token else request)
 
             try:
                 response = self.parent.data_client.reports().batchGet(
                     body={
-                        'reportRequests': [request],
+                        'reportRequests': requests,
                         'useResourceQuotas': False  # only for 360
                     }
                 ).execute()
@@ -486,34 +504,106 @@ class MegatonUA(ga4.MegatonGA4):
                 status = data['error']['status']
                 if code == 400 and status == 'INVALID_ARGUMENT':
                     raise errors.BadRequest(status)
-            except Exceptions as e:
-                raise e
-
-            report_data = response.get('reports', [])[0]
-            total_rows = report_data['data'].get('rowCount', 0)
-
-            samples_count = report_data['data'].get('samplesReadCounts')
-            samples_size = report_data['data'].get('samplingSpaceSizes')
-            next_token = report_data.get('nextPageToken', None)
-            if samples_count:
-                LOGGER.warn(f"samplesReadCounts = {samples_count}")
-            if samples_size:
-                LOGGER.warn(f"samplingSpaceSizes = {samples_size}")
-
-            data, headers, types = self._parse_response(report_data)
+                raise
+
+            pages = []
+            for report_data in response.get('reports', []):
+                total_rows = report_data['data'].get('rowCount', 0)
+
+                samples_count = report_data['data'].get('samplesReadCounts')
+                samples_size = report_data['data'].get('samplingSpaceSizes')
+                next_token = report_data.get('nextPageToken', None)
+                if (samples_count or samples_size) and unsampled:
+                    raise errors.SampledData(f"{samples_count} of {samples_size} sessions were read.")
+                if samples_count:
+                    LOGGER.warn(f"samplesReadCounts = {samples_count}")
+                if samples_size:
+                    LOGGER.warn(f"samplingSpaceSizes = {samples_size}")
+
+                data, headers, types = self._parse_response(report_data)
+                pages.append((data, total_rows, headers, types, next_token))
+
+            return pages
+
+        def _get_checkpoint(self, request: dict, checkpoint_dir: Optional[str] = None):
+            """Return a checkpoint for the request ignoring its page token"""
+            if checkpoint_dir:
+                body = {k: v for k, v in request.items() if k != 'pageToken'}
+                dates = [body['dateRanges'][0]['startDate'], body['dateRanges'][0]['endDate']]
+                return checkpoint.Checkpoint(checkpoint_dir, json.dumps(body, sort_keys=True), dates=dates)
+
+        def _fetch_page(self, token: str, request: dict, ckpt: Optional[checkpoint.Checkpoint] = None,
+                        unsampled: bool = False):
+            """Return a page from the checkpoint if it was saved, otherwise request it to API"""
+            return self._fetch_pages([token], request, ckpt, unsampled)[0]
+
+        def _fetch_pages(self, tokens: list, request: dict, ckpt: Optional[checkpoint.Checkpoint] = None,
+                         unsampled: bool = False):
+            """Return pages from the checkpoint if saved, and request the rest to API in a single batchGet"""
+            pages = {}
+            if ckpt:
+                info = ckpt.info
+                for token in tokens:
+                    if ckpt.has(token):
+                        pages[token] = (ckpt.load(token), info['total_rows'], info['headers'], info['types'],
+                                        ckpt.page(token)['next'])
+
+            missing = [t for t in tokens if t not in pages]
+            if missing:
+                for token, page in zip(missing, self._request_pages_api(missing, request, unsampled)):
+                    (data, total_rows, headers, types, next_token) = page
+                    if ckpt and len(data):
+                        if not ckpt.info:
+                            ckpt.update(total_rows=total_rows, headers=headers, types=types)
+                        ckpt.save(token, data, next=next_token)
+                    pages[token] = page
+            return [pages[t] for t in tokens]
+
+        def _iter_pages(self, request: dict, ckpt: Optional[checkpoint.Checkpoint] = None, workers: int = 1,
+                        unsampled: bool = False):
+            """Yield token and page of a report in order.
+            After the first page, the rest are requested in batches of up to 5 pages by multiple threads
+            when workers > 1, since page tokens are row offsets."""
+            token = "0"
+            page = self._fetch_page(token, request, ckpt, unsampled)
+            yield token, page
+            total_rows, next_token = page[1], page[4]
+
+            if workers > 1 and next_token:
+                size = int(next_token) - int(token)
+                tokens = [str(o) for o in range(int(next_token), total_rows, size)]
+                batches = utils.get_chunked_list(tokens, BATCH_SIZE)
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    futures = [executor.submit(self._fetch_pages, b, request, ckpt, unsampled) for b in batches]
+                    try:
+                        for batch, future in zip(batches, futures):
+                            for token, page in zip(batch, future.result()):
+                                yield token, page
+                    finally:
+                        for future in futures:
+                            future.cancel()
+                return
 
-            return data, total_rows, headers, types, next_token
+            while next_token:
+                token = next_token
+                page = self._fetch_page(token, request, ckpt, unsampled)
+                yield token, page
+                next_token = page[4]
 
-        def _report_generator(self, request: dict):
-            """Send request to get report data"""
+        def _report_generator(self, request: dict, checkpoint_dir: Optional[str] = None, workers: int = 1,
+                              unsampled: bool = False, chunks: bool = False):
+            """Send request to get report data. Yields rows, or a DataFrame for each page if chunks is True."""
             if not self.parent.view.id:
                 # LOGGER.error("Viewを先に選択してから実行してください。")
                 return
 
-            token = "0"
+            ckpt = self._get_checkpoint(request, checkpoint_dir)
+            pages = self._iter_pages(request, ckpt, workers, unsampled)
             while True:
                 try:
-                    (data, total_rows, headers, types, next_token) = self._request_report_api(token, request)
+                    token, (data, total_rows, headers, types, next_token) = next(pages)
+                except StopIteration:
+                    break
                 except err.HttpError as e:
                     value = str(sys.exc_info()[1])
                     if 'disabled' in value:
@@ -525,6 +615,10 @@ class MegatonUA(ga4.MegatonGA4):
                     else:
                         raise e
 
+                if isinstance(data, list):
+                    # page saved by an older version
+                    data = pd.DataFrame(data, columns=headers)
+
                 if token == "0" and total_rows:
                     LOGGER.info(f"Total {total_rows} rows found.")
 
@@ -539,20 +633,131 @@ class MegatonUA(ga4.MegatonGA4):
                 if len(data):
                     LOGGER.info(f"(received row #{token}-{int(token) + len(data) - 1})")
 
-                for row in data:
-                    yield row
+                if chunks:
+                    yield data
+                else:
+                    yield from data.itertuples(index=False, name=None)
 
                 if not next_token:
                     # no more data
+                    if ckpt:
+                        ckpt.finish()
                     break
                 if len(data) == 0:
                     # API bug
+                    pages.close()
                     raise errors.PartialDataReturned()
-
-                token = next_token
+            pages.close()
+
+        def _fetch_range(self, request: dict, start_date: str, end_date: str, checkpoint_dir: Optional[str] = None,
+                         unsampled: bool = False, workers: int = 1):
+            """Return the report for a date range as a DataFrame without changing the original request"""
+            sub_request = dict(request, dateRanges=[{'startDate': start_date, 'endDate': end_date}], pageToken="0")
+            return self._concat(list(self._report_generator(sub_request, checkpoint_dir, workers, unsampled,
+                                                            chunks=True)))
+
+        def _fetch_split(self, request: dict, start_date: str, end_date: str, checkpoint_dir: Optional[str] = None,
+                         workers: int = 4, split_on: tuple = (errors.SampledData,), ranges: Optional[list] = None,
+                         page_workers: int = 1):
+            """Fetch a report splitting the date range in halves whenever a range fails with one of the errors,
+            down to a single day. Ranges run in parallel and merged into a DataFrame in date order.
+            Finished ranges are saved to checkpoint_dir. Temporary HTTP errors are retried by data_client for each call.
+
+            Ranges of a single day still sampled are fetched as they are and kept in `self.sampled_ranges`.
+
+            Args:
+                ranges (list): (start_date, end_date) to begin with instead of the whole range
+                page_workers (int): number of batchGet calls to run at the same time within each range
+            Raises:
+                errors.IncompleteReport: when some ranges failed. The other ranges are finished first
+                    and their rows are kept in the exception.
+            """
+            unsampled = errors.SampledData in split_on
+            self.sampled_ranges = []
+            results = {}
+            failed = {}
+
+            def fetch(s, e, strict):
+                return self._fetch_range(request, s, e, checkpoint_dir, strict, page_workers)
+
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                pending = {executor.submit(fetch, r[0], r[1], unsampled): r for r in ranges or [(start_date, end_date)]}
+                while pending:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        s, e = pending.pop(future)
+                        try:
+                            results[s] = future.result()
+                            LOGGER.debug(f"{s} - {e}: {len(results[s])} rows")
+                        except split_on as ex:
+                            ranges = utils.split_date_range(s, e, 2)
+                            if len(ranges) > 1:
+                                LOGGER.info(f"{type(ex).__name__} for {s} - {e}. Splitting the range.")
+                                for r in ranges:
+                                    pending[executor.submit(fetch, r[0], r[1], unsampled)] = r
+                            elif isinstance(ex, errors.SampledData):
+                                LOGGER.warn(f"{s} is sampled even for a single day.")
+                                self.sampled_ranges.append((s, e))
+                                pending[executor.submit(fetch, s, e, False)] = (s, e)
+                            else:
+                                LOGGER.error(f"{s} - {e} failed: {ex!r}")
+                                failed[(s, e)] = ex
+                        except Exception as ex:
+                            # keep fetching the other ranges
+                            LOGGER.error(f"{s} - {e} failed: {ex!r}")
+                            failed[(s, e)] = ex
+            df = self._concat([results[s] for s in sorted(results)])
+            if failed:
+                first = min(failed)
+                raise errors.IncompleteReport(
+                    f"{len(failed)} date ranges failed: {sorted(failed)}. {failed[first]!r}",
+                    data=df.values.tolist(), headers=list(df.columns)) from failed[first]
+            return df
+
+        def _concat(self, frames: list, categorical: bool = True):
+            """Concatenate DataFrames of pages. Dimensions are kept categorical or turned back into strings."""
+            frames = [f for f in frames if len(f)]
+            if not frames:
+                return pd.DataFrame()
+            dimensions = [c for c in frames[0].columns if isinstance(frames[0][c].dtype, pd.CategoricalDtype)]
+            df = pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0]
+            for col in dimensions:
+                df[col] = df[col].astype('category' if categorical else object)
+            return df
+
+        def _collect(self, frames, writer=None, categorical: bool = False):
+            """Return a DataFrame of all pages, or pass them to the writer if given"""
+            if writer:
+                for df in frames:
+                    writer.append_df(self._concat([df], categorical))
+                return None
+            return self._concat(list(frames), categorical)
 
         def show(self, dimensions: list, metrics: list, return_generator: Optional[bool] = None, **kwargs):
-            """Get Analytics report data"""
+            """Get Analytics report data
+
+            Args:
+                dimensions (list): api_name of dimensions
+                metrics (list): api_name of metrics
+                return_generator (bool): return a generator of rows instead of a DataFrame
+                    Dimensions such as date and dateHour are converted to date and datetime
+                    by utils.change_column_type in every form of the result.
+                chunks (bool): make the generator yield a DataFrame for each page instead of rows
+                categorical (bool): return dimensions as categorical columns
+                checkpoint_dir (str): save each page (and each range when the dates are split) to this directory
+                    so that a rerun resumes from the first missing page
+                to_parquet (str): write rows to a Parquet dataset in this directory as they arrive
+                    and return a pyarrow dataset to read lazily instead of the data
+                memory_budget (int): bytes of rows to keep in memory before writing them with to_parquet
+                partition_cols (list): columns to partition the Parquet dataset by
+                overwrite (bool): allow to_parquet to be a directory with files, replacing Parquet files
+                    of an earlier run in it
+                workers (int): number of batchGet calls to run at the same time after the first page.
+                    Each call requests up to 5 pages.
+                unsampled (bool): when the report is sampled, split the date range in halves recursively
+                    (down to a single day) and fetch the parts in parallel. Ranges still sampled are kept
+                    in `sampled_ranges`.
+            """
             if not self.parent.view.id:
                 LOGGER.error("Viewを先に選択してから実行してください。")
                 return
@@ -582,31 +787,111 @@ class MegatonUA(ga4.MegatonGA4):
             )
             # print(request)
 
-            iterator = self._report_generator(request)
+            checkpoint_dir = kwargs.get('checkpoint_dir')
+            workers = kwargs.get('workers', 1)
+            categorical = kwargs.get('categorical', False)
+            self.sampled_ranges = []
+            if kwargs.get('unsampled'):
+                frames = iter([self._fetch_split(
+                    request, start_date, end_date, checkpoint_dir, max(workers, 4),
+                    split_on=(errors.SampledData, errors.PartialDataReturned), page_workers=workers)])
+            else:
+                frames = self._report_generator(request, checkpoint_dir, workers, chunks=True)
 
             if return_generator:
-                return iterator
+                # dates are converted as in the DataFrame returned otherwise
+                frames = (utils.change_column_type(df) for df in frames)
+                if kwargs.get('chunks'):
+                    return frames
+                return (list(row) for df in frames for row in df.itertuples(index=False, name=None))
 
+            writer = self._get_writer(kwargs, utils.change_column_type)
             try:
-                return pd.DataFrame(list(iterator), columns=self.headers)
-            except AttributeError:
-                LOGGER.info("No data found.")
-                return pd.DataFrame()
+                df = self._collect(frames, writer, categorical)
             except errors.PartialDataReturned:
                 LOGGER.warn("APIのバグにより全データを取得できませんでした。")
-                if start_date != end_date:
-                    LOGGER.warn("1日毎にデータを分割して取得します。")
-                    all_data = []
-                    for date in utils.get_date_range(start_date, end_date):
-                        print(f"...{date}", end='')
-                        request['dateRanges'][0]['startDate'] = date
-                        request['dateRanges'][0]['endDate'] = date
-                        request['pageToken'] = "0"
-                        iterator = self._report_generator(request)
-                        data = list(iterator)
-                        LOGGER.debug(f"{len(data)} rows")
-                        all_data.extend(data)
-                    return pd.DataFrame(all_data, columns=self.headers)
+                if start_date == end_date:
+                    raise
+                LOGGER.warn("期間を分割して並列で取得します。")
+                if writer:
+                    writer.clear()
+                frames = iter([self._fetch_split(
+                    request, start_date, end_date, checkpoint_dir, max(workers, 4),
+                    split_on=(errors.PartialDataReturned,),
+                    ranges=utils.split_date_range(start_date, end_date, 2), page_workers=workers)])
+                df = self._collect(frames, writer, categorical)
+
+            if self.sampled_ranges:
+                LOGGER.warn(f"Sampled data remains in {self.sampled_ranges}")
+            if writer:
+                dataset = writer.close()
+                LOGGER.info(f"All {writer.rows} rows were written to {writer.path}")
+                return dataset
+            if not len(df):
+                LOGGER.info("No data found.")
+            return utils.change_column_type(df)
+
+
+# client_id単位の元データ：ContentAnalysisの各抽出はここから集計する
+CID_BASE_DIMENSIONS = ['clientId', 'sessionCount', 'date', 'pagePath', 'hostname']
+CID_BASE_METRICS = ['entrances', 'uniquePageviews', 'exits']
+OPERATORS = {'==': operator.eq, '!=': operator.ne, '<=': operator.le, '>=': operator.ge, '<': operator.lt,
+             '>': operator.gt}
+
+
+def _get_cached_report(ga3, name: str, refresh: bool = False, **kwargs):
+    """同じビュー・期間・条件のレポートは一度だけ抽出し、キャッシュしたものを返す"""
+    start_date = utils.resolve_date(ga3.report.start_date)
+    end_date = utils.resolve_date(ga3.report.end_date)
+    key = ga3._cache_key(name, ga3.view.id, start_date, end_date, json.dumps(kwargs, sort_keys=True))
+    df = None if refresh else ga3.cache.get(key)
+    if df is None:
+        df = ga3.report.show(
+            start_date=start_date.strftime('%Y-%m-%d'),
+            end_date=end_date.strftime('%Y-%m-%d'),
+            **kwargs,
+        )
+        if df is None or not len(df):
+            return pd.DataFrame(columns=kwargs['dimensions'] + kwargs['metrics'])
+        ga3.cache.set(key, df)
+    return df
+
+
+def _base_pages(conf: dict):
+    """元データに含めるページ：対象ページと各CVページ。どれかが全ページなら絞り込まない"""
+    pages = [conf.get('include_pages')] + [conf.get(f'{i}_pages') for i in ['cv', 'm1', 'm2', 'm3', 'm4', 'm5']
+                                           if conf.get(f'{i}_pages')]
+    return [] if not all(pages) else pages
+
+
+def get_cid_base(ga3, pages: Optional[list] = None, refresh: bool = False):
+    """元データ抽出：client_id,セッションカウント,日付,ページ,ホスト名ごとの入口, PV, 出口
+    ページの条件は1つの正規表現にまとめてAPIで絞り込み、ホスト名と除外ページは取得後に判定する
+    Args:
+        pages (list): pagePathの正規表現。省略すると全ページ
+    """
+    return _get_cached_report(
+        ga3, 'cid_base', refresh,
+        dimensions=CID_BASE_DIMENSIONS,
+        metrics=CID_BASE_METRICS,
+        dimension_filter=f"pagePath=~{'|'.join(f'(?:{p})' for p in pages)}" if pages else None,
+        order_bys='clientId,sessionCount,date,pagePath',
+    )
+
+
+def _match(series: pd.Series, regex: str):
+    """Return a mask of values matching a regex like =~ in filters of Analytics,
+    which were sent with caseSensitive: False. Each distinct value is matched once."""
+    pattern = re.compile(regex, re.IGNORECASE)
+    codes, values = pd.factorize(series)
+    # missing values have the code -1, which picks the False appended at the end
+    matched = np.array([pattern.search(str(v)) is not None for v in values] + [False])
+    return pd.Series(matched[codes], index=series.index)
+
+
+def _aggregate(df: pd.DataFrame, dimensions: list, metrics: list):
+    """Sum metrics of the base data by the dimensions"""
+    return df.groupby(dimensions, sort=True, observed=True)[metrics].sum().reset_index()
 
 
 def get_cid_date_page(ga3, conf: dict):
@@ -616,30 +901,15 @@ def get_cid_date_page(ga3, conf: dict):
         Metrics:
             入口, PV, 出口
     """
-    filter = []
+    df = get_cid_base(ga3, _base_pages(conf))
+    mask = pd.Series(True, index=df.index)
     if conf['include_domains']:
-        filter.append(f"hostname=~{conf['include_domains']}")
+        mask &= _match(df['hostname'], conf['include_domains'])
     if conf['include_pages']:
-        filter.append(f"pagePath=~{conf['include_pages']}")
+        mask &= _match(df['pagePath'], conf['include_pages'])
     if conf['exclude_pages']:
-        filter.append(f"pagePath!~{conf['exclude_pages']}")
-    dimension_filter = ";".join(filter)
-
-    df = ga3.report.show(
-        dimensions=[
-            'clientId',
-            'sessionCount',
-            'date',
-            'pagePath',
-        ],
-        dimension_filter=dimension_filter,
-        metrics=[
-            'entrances',
-            'uniquePageviews',
-            'exits',
-        ],
-        order_bys='clientId,sessionCount,date,pagePath',
-    )
+        mask &= ~_match(df['pagePath'], conf['exclude_pages'])
+    df = _aggregate(df[mask], ['clientId', 'sessionCount', 'date', 'pagePath'], CID_BASE_METRICS)
 
     if len(df):
         # 値を変換
@@ -661,48 +931,49 @@ def get_last_returned_date(ga3):
         Metrics:
             入口
     """
-    df = ga3.report.show(
-        dimensions=[
-            'clientId',
-            'date',
-        ],
+    # 全ページが対象なので、ページ単位の元データではなくclient_idと日付だけを抽出する
+    df = _get_cached_report(
+        ga3, 'last_returned',
+        dimensions=['clientId', 'date'],
         dimension_filter='ga:sessionCount!=1',
-        metrics=[
-            'entrances',  # 不要
-        ],
+        metrics=['entrances'],  # 不要
         order_bys='ga:clientId,ga:date',
     )
 
     # cid単位でまとめて最後に訪問した日を算出
-    _df = df.groupby(['clientId']).max().rename(columns={'date': 'last_visit_date'})
-
-    return _df.drop(['entrances'], inplace=False, axis=1)
+    return df[['clientId', 'date']].groupby(['clientId']).max().rename(columns={'date': 'last_visit_date'})
 
 
-def get_no_entrance_cv_cid(ga3, include_pages=None, metric_filter: str = 'ga:entrances<1'):
+def get_no_entrance_cv_cid(ga3, include_pages=None, metric_filter: str = 'ga:entrances<1',
+                           conf: Optional[dict] = None):
     """元データ抽出：入口以外でCVページに到達したcid
+    Args:
+        conf (dict): ContentAnalysisの設定。指定するとget_cid_date_pageと同じ元データから判定する
     """
-    filter = []
+    match = re.match(rf"^(?:ga:)?({'|'.join(CID_BASE_METRICS)})(==|!=|<=|>=|<|>)(\d+)$", metric_filter or '')
+    if metric_filter and not match:
+        # 元データで判定できない条件はAPIで抽出する
+        filter = []
+        if include_pages:
+            filter.append(f'pagePath=~{include_pages}')
+        _df = ga3.report.show(
+            dimensions=['pagePath', 'clientId', 'date', 'sessionCount'],
+            dimension_filter=";".join(filter),
+            metrics=['users'],
+            metric_filter=metric_filter,
+            order_bys='pagePath,clientId,date',
+        )
+        return _df.drop(['users'], axis=1) if len(_df) else pd.DataFrame()
+
+    df = get_cid_base(ga3, _base_pages(conf) if conf else [include_pages] if include_pages else None)
     if include_pages:
-        filter.append(f'pagePath=~{include_pages}')
-    dimension_filter = ";".join(filter)
-
-    _df = ga3.report.show(
-        dimensions=[
-            'pagePath',  # 不要（確認のため）
-            'clientId',
-            'date',
-            'sessionCount',
-        ],
-        dimension_filter=dimension_filter,
-        metrics=[
-            'users',  # 不要
-        ],
-        metric_filter=metric_filter,
-        order_bys='pagePath,clientId,date',
-    )
+        df = df[_match(df['pagePath'], include_pages)]
+    _df = _aggregate(df, ['pagePath', 'clientId', 'date', 'sessionCount'], CID_BASE_METRICS)
+    if match:
+        metric, op, value = match.groups()
+        _df = _df[OPERATORS[op](_df[metric], int(value))]
     if len(_df):
-        return _df.drop(['users'], axis=1)
+        return _df.drop(CID_BASE_METRICS, axis=1).reset_index(drop=True)
     else:
         return pd.DataFrame()
 
@@ -749,3 +1020,119 @@ def get_page_title(ga3, conf: dict):
         ).groupby('page').first().reset_index()[['page', 'title']]
     except KeyError:
         raise errors.NoDataReturned
+
+
+def _parse_property(i: dict):
+    return {
+        'id': i['id'],
+        'name': i['name'],
+        'industry': i.get('industryVertical', ''),
+        'service_level': i['level'],
+        'created_time': i['created'],
+        'updated_time': i['updated'],
+        'data_retention': i['dataRetentionTtl'],
+        'data_retention_reset_on_activity': i['dataRetentionResetOnNewActivity'],
+        'properties': '',
+    }
+
+
+def _parse_view(i: dict):
+    return {
+        'property_id': i['webPropertyId'],
+        'id': i['id'],
+        'name': i['name'],
+        'currency': i['currency'],
+        'time_zone': i['timezone'],
+        'url': i['websiteUrl'],
+        'type': i['type'],
+        'ecommerce': i['eCommerceTracking'],
+        'bot_filtering': i.get('botFilteringEnabled', False),
+        'site_search_parameters': i.get('siteSearchQueryParameters', ''),
+        'default_page': i.get('defaultPage', ''),
+        'created_time': i['created'],
+        'updated_time': i['updated'],
+    }
+
+
+def _parse_custom_dimension(i: dict):
+    return {
+        'index': i['index'],
+        'display_name': i['name'],
+        'scope': i['scope'],
+        'active': i['active'],
+    }
+
+
+def _parse_custom_metric(i: dict):
+    return {
+        'index': i['index'],
+        'display_name': i['name'],
+        'scope': i['scope'],
+        'type': i['type'],
+        'active': i['active'],
+    }
+
+
+def _parse_goal(i: dict):
+    return {
+        'id': i.get('id'),
+        'name': i.get('name'),
+        'value': i.get('value'),
+        'type': i.get('type'),
+        'url_destination': i.get('urlDestinationDetails'),
+        'time_on_site': i.get('visitTimeOnSiteDetails'),
+        'pages_per_session': i.get('visitNumPagesDetails'),
+        'event': i.get('eventDetails'),
+        'created_time': i.get('created'),
+        'updated_time': i.get('updated'),
+        'active': i.get('active'),
+    }
+
+
+def _parse_segment(i: dict):
+    return {
+        'id': i['id'],
+        'name': i['name'],
+        'type': i['type'],
+        'definition': i['definition'],
+    }
+
+
+def _convert_column(values: list, type: str):
+    """Convert values of a UA metric to numbers at once. Values are kept as strings if they are not numeric.
+    TIME is converted to seconds whether it is given in seconds or in HH:MM:SS format."""
+    column = pd.Series(values, dtype=object)
+    try:
+        if type == 'TIME' and column.str.contains(':', regex=False).any():
+            return pd.to_timedelta(column).dt.total_seconds()
+        if type == 'INTEGER':
+            return pd.to_numeric(column).astype('int64')
+        if type in ['FLOAT', 'CURRENCY', 'PERCENT', 'TIME']:
+            return pd.to_numeric(column).astype('float64')
+    except (ValueError, TypeError):
+        pass
+    return column
+
+
+def decode_report(report: dict):
+    """Decode rows of a report in a batchGet response into a DataFrame one column at a time
+
+    Dimensions become categorical columns, and metrics are converted to int64 or float64 by their types.
+    Returns:
+        DataFrame, headers and types like Report._parse_response
+    """
+    header = report['columnHeader']
+    names = [d.replace('ga:', '') for d in header.get('dimensions', [])]
+    entries = header['metricHeader']['metricHeaderEntries']
+    types = ['category'] * len(names) + [e['type'] for e in entries]
+    rows = report['data'].get('rows', [])
+
+    columns = {}
+    dimensions = list(zip(*[r['dimensions'] for r in rows])) if names else []
+    for i, name in enumerate(names):
+        columns[name] = pd.Categorical(dimensions[i] if rows else [])
+    metrics = list(zip(*[r['metrics'][0]['values'] for r in rows]))
+    for i, e in enumerate(entries):
+        columns[e['name']] = _convert_column(list(metrics[i]) if rows else [], e['type'])
+    names += [e['name'] for e in entries]
+    return pd.DataFrame(columns, columns=names), names, types
@@ -2,42 +2,29 @@
 Functions for Google Analytics 4 API
 """
 
+from array import array
 from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
 from typing import Optional
+import hashlib
 import logging
+import multiprocessing
 import pandas as pd
 import pytz
 import re
 import sys
 
-from google.analytics.admin import AnalyticsAdminServiceClient
-from google.analytics.admin_v1alpha.types import CustomDimension
-from google.analytics.admin_v1alpha.types import CustomMetric
-from google.analytics.admin_v1alpha.types import DataRetentionSettings
-from google.analytics.admin_v1alpha.types import IndustryCategory
-from google.analytics.admin_v1alpha.types import ServiceLevel
-from google.analytics.data import BetaAnalyticsDataClient
-from google.analytics.data_v1beta.types import DateRange
-from google.analytics.data_v1beta.types import Dimension
-from google.analytics.data_v1beta.types import Filter
-from google.analytics.data_v1beta.types import FilterExpression
-from google.analytics.data_v1beta.types import FilterExpressionList
-from google.analytics.data_v1beta.types import Metadata
-from google.analytics.data_v1beta.types import Metric
-from google.analytics.data_v1beta.types import MetricAggregation
-from google.analytics.data_v1beta.types import MetricType
-from google.analytics.data_v1beta.types import NumericValue
-from google.analytics.data_v1beta.types import OrderBy
-from google.analytics.data_v1beta.types import RunReportRequest
-from google.analytics.data_v1beta.types import RunReportResponse
-from google.api_core.exceptions import PermissionDenied
-from google.api_core.exceptions import ServiceUnavailable
-from google.api_core.exceptions import Unauthenticated
 from google.oauth2.credentials import Credentials
-# from tenacity import retry, retry_if_exception_type, stop_after_attempt
 
-from . import errors, google_api, utils
+from . import cache, checkpoint, constants, errors, ratelimit, retry, spill, utils
+
+# heavy client libraries are imported when GA4 is first used
+ga_admin = utils.lazy_import('google.analytics.admin_v1alpha')
+ga_data = utils.lazy_import('google.analytics.data_v1beta')
+api_exceptions = utils.lazy_import('google.api_core.exceptions')
+grpc = utils.lazy_import('grpc')
+pa = utils.lazy_import('pyarrow')
 
 LOGGER = logging.getLogger(__name__)
 
@@ -50,12 +37,32 @@ class MegatonGA4(object):
     ]
 
     def __init__(self, credentials: Credentials, **kwargs):
-        """constructor"""
+        """constructor
+
+        Args:
+            credentials: credentials to access APIs
+            credential_cache_file (str): path to the credential cache file
+            cache_dir (str): directory to keep account and property summaries across sessions
+            cache_ttl (int): seconds until the cached summaries expire
+            page_size (int): number of account summaries to load per API call
+            rate_limiter (RateLimiter): limiter to pass every API call through
+            retry_policy (RetryPolicy): how to retry API calls failing with temporary errors
+            channel_options (ChannelOptions): compression, message size, keepalive, timeout and pooling
+                of the channels used by API clients
+        """
         self.credentials = credentials
         self.credential_cache_file = kwargs.get('credential_cache_file')
+        self.cache = cache.DiskCache(kwargs.get('cache_dir'), ttl=kwargs.get('cache_ttl', 86400))
+        self.page_size = kwargs.get('page_size', 50)
+        self.rate_limiter = kwargs.get('rate_limiter')
+        self.retry_policy = kwargs.get('retry_policy') or retry.RetryPolicy()
+        self.channel_options = kwargs.get('channel_options')
+        if self.channel_options and self.channel_options.timeout and not self.retry_policy.timeout:
+            self.retry_policy.timeout = self.channel_options.timeout
         self.data_client = None
         self.admin_client = None
-        self.accounts = None
+        self._accounts = None
+        self._account_pages = None
         self.account = self.Account(self)
         self.property = self.Property(self)
         self.report = self.Report(self)
@@ -70,11 +77,123 @@ class MegatonGA4(object):
         dict = self.admin_client.parse_property_path(path)
         return dict.get('property')
 
+    def _cache_key(self, *args):
+        """Build a cache key unique to the caller"""
+        identity = getattr(self.credentials, 'service_account_email', None) \
+            or getattr(self.credentials, 'refresh_token', None) \
+            or getattr(self.credentials, 'client_id', None) or ''
+        who = hashlib.sha1(str(identity).encode('utf-8')).hexdigest()
+        return ':'.join([self.this, who] + [str(a) for a in args])
+
+    def _call(self, method, *args, deadline: Optional[retry.Deadline] = None, **kwargs):
+        """Call a client method through the retry policy.
+        The client's own retry is disabled so that the policy alone decides."""
+        return self.retry_policy.call(method, *args, deadline=deadline, retry=None, **kwargs)
+
+    def _pages(self, method, request: dict):
+        """Yield response pages of a list method.
+        Every page is requested through _call, whereas a pager fetches the following pages
+        without the retry policy and the rate limiter."""
+        request = dict(request)
+        while True:
+            page = next(self._call(method, request).pages)
+            yield page
+            if not page.next_page_token:
+                return
+            request['page_token'] = page.next_page_token
+
+    def _parse_account_summaries(self, summaries):
+        results = []
+        for i in summaries:
+            dict1 = {
+                'id': self._get_account_id_from_account_path(i.account),
+                'name': i.display_name,
+                'properties': [],
+            }
+            for p in i.property_summaries:
+                dict2 = {
+                    'id': self._get_property_id_from_property_path(p.property),
+                    'name': p.display_name
+                }
+                dict1['properties'].append(dict2)
+            results.append(dict1)
+        return results
+
+    @property
+    def accounts(self):
+        """Account summaries accessible by the caller. Remaining pages are loaded on first access."""
+        if self._account_pages is not None:
+            for _ in self.iter_accounts():
+                pass
+        return self._accounts
+
+    @accounts.setter
+    def accounts(self, value):
+        self._accounts = value
+        self._account_pages = None
+
+    def iter_accounts(self):
+        """Yield account summaries, loading the next page only when it is needed."""
+        i = 0
+        while True:
+            while self._accounts and i < len(self._accounts):
+                yield self._accounts[i]
+                i += 1
+            if not self._load_next_page():
+                return
+
+    def _load_next_page(self) -> bool:
+        """Load the next page of account summaries. Returns False when all pages have been loaded."""
+        if self._account_pages is None:
+            return False
+        page = next(self._account_pages, None)
+        if page is None:
+            self._account_pages = None
+            self._save_accounts()
+            return False
+        self._accounts.extend(self._parse_account_summaries(page.account_summaries))
+        return True
+
+    @property
+    def loaded_accounts(self) -> list:
+        """Account summaries loaded so far, without loading the remaining pages"""
+        return self._accounts or []
+
+    @property
+    def more_accounts(self) -> bool:
+        """True if account summaries have pages not loaded yet"""
+        return self._account_pages is not None
+
+    def load_more_accounts(self) -> list:
+        """Load the next page of account summaries and return the accounts in it"""
+        n = len(self.loaded_accounts)
+        self._load_next_page()
+        return self.loaded_accounts[n:]
+
+    def _save_accounts(self):
+        """Save fully loaded account summaries to the cache"""
+        if self._accounts is not None and self._account_pages is None:
+            self.cache.set(self._cache_key('accounts'), self._accounts)
+
+    def reload(self):
+        """Discard cached summaries of the caller and load them again from API.
+        Entries of other callers sharing the cache directory are kept."""
+        accounts = (self._accounts or []) + (self.cache.get(self._cache_key('accounts')) or [])
+        for account_id in {a['id'] for a in accounts}:
+            self.cache.delete(self._cache_key('properties', account_id))
+        self.cache.delete(self._cache_key('accounts'))
+        self.account.id = None
+        self._update()
+        self._save_accounts()
+        return self.accounts
+
     def _update(self):
-        """Returns account summaries accessible by the caller."""
+        """Loads the first page of account summaries accessible by the caller.
+        Following pages are loaded when accounts are iterated."""
         try:
-            results_iterator = self.admin_client.list_account_summaries()
-        except PermissionDenied as e:
+            pages = self._pages(self.admin_client.list_account_summaries, {'page_size': self.page_size})
+            first_page = next(pages, None)
+        except api_exceptions.PermissionDenied as e:
             LOGGER.error("APIを使う権限がありません。")
             message = getattr(e, 'message', repr(e))
             LOGGER.warn(message)
@@ -83,15 +202,15 @@ class MegatonGA4(object):
                 reason = m.group(1)
                 if reason == 'SERVICE_DISABLED':
                     LOGGER.error("GCPのプロジェクトでAdmin APIを有効化してください。")
-                    raise error.ApiDisabled
-        except ServiceUnavailable as e:
+                    raise errors.ApiDisabled
+        except api_exceptions.ServiceUnavailable as e:
             value = str(sys.exc_info()[1])
             m = re.search(r"error: \('([^:']+): ([^']+)", value)
             if m and m.group(1) == 'invalid_grant':
                 LOGGER.error(f"認証の期限が切れています。{m.group(2)}")
                 self.credentials = None
             raise e
-        except Unauthenticated as e:
+        except api_exceptions.Unauthenticated as e:
             LOGGER.error("認証に失敗しました。")
             self.credentials = None
             LOGGER.warn(sys.exc_info()[1])
@@ -100,24 +219,13 @@ class MegatonGA4(object):
             LOGGER.error(value)
             raise e
         else:
-            results = []
-            for i in results_iterator:
-                dict1 = {
-                    'id': self._get_account_id_from_account_path(i.account),
-                    'name': i.display_name,
-                    'properties': [],
-                }
-                for p in i.property_summaries:
-                    dict2 = {
-                        'id': self._get_property_id_from_property_path(p.property),
-                        'name': p.display_name
-                    }
-                    dict1['properties'].append(dict2)
-                results.append(dict1)
-            self.accounts = results
-            return results
+            if first_page is None:
+                self.accounts = []
+                return self._accounts
+            self._accounts = self._parse_account_summaries(first_page.account_summaries)
+            self._account_pages = pages if first_page.next_page_token else None
+            return self._accounts
 
-    # retry(stop=stop_after_attempt(1), retry=retry_if_exception_type(ServiceUnavailable))
     def authorize(self):
         if not isinstance(self.credentials, Credentials):
             LOGGER.error("The credentials given are in invalid format.")
@@ -126,8 +234,14 @@ class MegatonGA4(object):
 
         self.build_client()
 
-        if not self._update():
+        cached = self.cache.get(self._cache_key('accounts'))
+        if cached is not None:
+            LOGGER.debug("loaded account summaries from cache")
+            self.accounts = cached
+        elif not self._update():
             return
+        else:
+            self._save_accounts()
 
         if bool(set(self.credentials.scopes) & set(self.required_scopes)):
             LOGGER.info(f"{self.this} launched!")
@@ -137,23 +251,111 @@ class MegatonGA4(object):
             raise errors.BadCredentialScope(self.required_scopes)
 
     def build_client(self):
-        self.data_client = BetaAnalyticsDataClient(credentials=self.credentials)
-        self.admin_client = AnalyticsAdminServiceClient(credentials=self.credentials)
+        if self.channel_options:
+            self.data_client = self.channel_options.build_client(ga_data.BetaAnalyticsDataClient, self.credentials)
+            self.admin_client = self.channel_options.build_client(
+                ga_admin.AnalyticsAdminServiceClient, self.credentials)
+        else:
+            self.data_client = ga_data.BetaAnalyticsDataClient(credentials=self.credentials)
+            self.admin_client = ga_admin.AnalyticsAdminServiceClient(credentials=self.credentials)
+        if self.rate_limiter:
+            self.data_client = ratelimit.Throttled(self.data_client, self.rate_limiter)
+            self.admin_client = ratelimit.Throttled(self.admin_client, self.rate_limiter)
+
+    def _get_account_properties(self, account: dict):
+        """Returns property summaries for the account, using the cache when available"""
+        key = self._cache_key('properties', account['id'])
+        properties = self.cache.get(key)
+        if properties is None:
+            properties = self.cache.set(key, self.account._get_properties(account['id']))
+        return [dict(p, account_id=account['id'], account_name=account['name']) for p in properties or []]
+
+    def _get_property_details(self, property_id: str, item: str):
+        """Returns a detail of the property using the same calls as Property"""
+        if item == 'data_retention':
+            return self.property._get_data_retention(property_id)
+        elif item == 'custom_dimensions':
+            return self.property._get_custom_dimensions(property_id)
+        elif item == 'custom_metrics':
+            return self.property._get_custom_metrics(property_id)
+        elif item == 'metadata':
+            return self.property._get_metadata(property_id)
+
+    def inventory(self, property_ids: Optional[list] = None, max_workers: int = 8, metadata: bool = True):
+        """Collect details of all accessible properties in parallel
+        Args:
+            property_ids (list): properties to collect. All accessible properties if omitted.
+            max_workers (int): number of API calls to run at the same time
+            metadata (bool): include dimensions and metrics available in Data API
+        Returns:
+            dict of DataFrames: properties, custom_dimensions, custom_metrics, dimensions, metrics and errors
+        """
+        items = ['data_retention', 'custom_dimensions', 'custom_metrics']
+        if metadata:
+            items.append('metadata')
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            properties = []
+            for result in executor.map(self._get_account_properties, self.accounts or []):
+                properties.extend(result)
+            if property_ids:
+                property_ids = [str(i) for i in property_ids]
+                properties = [p for p in properties if p['id'] in property_ids]
+            LOGGER.info(f"Collecting details of {len(properties)} properties...")
+
+            futures = {
+                (p['id'], item): executor.submit(self._get_property_details, p['id'], item)
+                for p in properties for item in items
+            }
+
+        tables = {k: [] for k in ['properties', 'custom_dimensions', 'custom_metrics', 'dimensions', 'metrics', 'errors']}
+        for p in properties:
+            row = {k: v for k, v in p.items() if k != 'id'}
+            row = {'property_id': p['id'], **row}
+            for item in items:
+                try:
+                    result = futures[(p['id'], item)].result()
+                except Exception as e:
+                    result = None
+                    tables['errors'].append({'property_id': p['id'], 'item': item, 'error': repr(e)})
+                else:
+                    if result is None:
+                        tables['errors'].append({'property_id': p['id'], 'item': item, 'error': 'no response'})
+                if not result:
+                    continue
+                if item == 'data_retention':
+                    row['data_retention'] = result['data_retention']
+                    row['data_retention_reset_on_activity'] = result['reset_user_data_on_new_activity']
+                elif item == 'metadata':
+                    for d in result['dimensions']:
+                        tables['dimensions'].append({'property_id': p['id'], **d})
+                    for m in result['metrics']:
+                        m = dict(m, type=ga_data.MetricType(m['type']).name)
+                        tables['metrics'].append({'property_id': p['id'], **m})
+                else:
+                    for d in result:
+                        tables[item].append({'property_id': p['id'], **d})
+            tables['properties'].append(row)
+        LOGGER.info("...done")
+
+        return {k: pd.DataFrame(v) for k, v in tables.items()}
 
     class Account(object):
         def __init__(self, parent):
             self.parent = parent
             self.id = None
             self.properties = None
+            self._prefetcher = None
+            self._prefetching = {}
 
-        def _update(self):
-            """Update summaries of all properties for the account"""
+        def _get_properties(self, account_id: str):
+            """Returns summaries of all properties for the account"""
             try:
-                results_iterator = self.parent.admin_client.list_properties({
-                    'filter': f"parent:accounts/{self.id}",
+                results_iterator = [i for page in self.parent._pages(self.parent.admin_client.list_properties, {
+                    'filter': f"parent:accounts/{account_id}",
                     'show_deleted': False,
-                })
-            except ServiceUnavailable as e:
+                }) for i in page.properties]
+            except api_exceptions.ServiceUnavailable as e:
                 # str(sys.exc_info()[1])
                 type, value, traceback = sys.exc_info()
                 LOGGER.debug(type)
@@ -171,23 +373,76 @@ class MegatonGA4(object):
                         'name': i.display_name,
                         'time_zone': i.time_zone,
                         'currency': i.currency_code,
-                        'industry': IndustryCategory(i.industry_category).name,
-                        'service_level': ServiceLevel(i.service_level).name,
+                        'industry': ga_admin.IndustryCategory(i.industry_category).name,
+                        'service_level': ga_admin.ServiceLevel(i.service_level).name,
                         'created_time': convert_proto_datetime(i.create_time),
                         'updated_time': convert_proto_datetime(i.update_time),
                     }
                     results.append(dict)
-                self.properties = results
                 return results
 
+        def _update(self):
+            """Update summaries of all properties for the account"""
+            self.properties = self._get_properties(self.id)
+            return self.properties
+
+        def _save(self):
+            """Save property summaries of the account to the cache"""
+            if self.id and self.properties is not None:
+                self.parent.cache.set(self.parent._cache_key('properties', self.id), self.properties)
+
+        def _fetch_details(self, prop: dict):
+            """Add data retention settings to a property summary"""
+            dict2 = self.parent.property._get_data_retention(prop['id'])
+            if dict2:
+                prop['data_retention'] = dict2['data_retention']
+                prop['data_retention_reset_on_activity'] = dict2['reset_user_data_on_new_activity']
+            return prop
+
         def select(self, id: str):
             if id:
                 if id != self.id:
                     self.id = id
-                    self._update()
+                    self.properties = self.parent.cache.get(self.parent._cache_key('properties', id))
+                    if self.properties is None:
+                        self._update()
+                        self._save()
             else:
                 self.parent.property.id = None
 
+        def prefetch(self, max_workers: int = 4, wait: bool = False):
+            """Fetch details of all properties for the account in background threads.
+            Accounts are prefetched one after another by a single background worker,
+            and an account already waiting or in progress is not added again.
+            Args:
+                max_workers (int): number of API calls to run at the same time
+                wait (bool): block until all details are fetched
+            Returns:
+                Future of the background job, or None if wait is True or nothing is to be fetched
+            """
+            account_id, properties = self.id, self.properties
+            targets = [p for p in properties or [] if not p.get('data_retention')]
+
+            def job():
+                with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                    list(executor.map(self._fetch_details, targets))
+                # the account may have been changed in the meantime
+                self.parent.cache.set(self.parent._cache_key('properties', account_id), properties)
+
+            if not targets:
+                return
+            if wait:
+                job()
+                return
+            future = self._prefetching.get(account_id)
+            if future and not future.done():
+                return future
+            if not self._prefetcher:
+                self._prefetcher = ThreadPoolExecutor(max_workers=1, thread_name_prefix='prefetch')
+            future = self._prefetcher.submit(job)
+            self._prefetching[account_id] = future
+            return future
+
         def show(self, index_col: str = 'id'):
             res = self.properties
             if res:
@@ -230,12 +485,12 @@ class MegatonGA4(object):
             self.dimensions = None
             self.metrics = None
 
-        def _get_metadata(self):
+        def _get_metadata(self, property_id: Optional[str] = None):
             """Returns available dimensions and metrics for the property."""
-            path = self.parent.data_client.metadata_path(self.id)
+            path = self.parent.data_client.metadata_path(property_id or self.id)
             try:
-                response = self.parent.data_client.get_metadata(name=path)
-            except PermissionDenied as e:
+                response = self.parent._call(self.parent.data_client.get_metadata, name=path)
+            except api_exceptions.PermissionDenied as e:
                 LOGGER.error("APIを使う権限がありません。")
                 m = re.search(r'reason: "([^"]+)', str(sys.exc_info()[1]))
                 if m:
@@ -272,11 +527,12 @@ class MegatonGA4(object):
                     })
                 return {'dimensions': dimensions, 'metrics': metrics}
 
-        def _get_custom_dimensions(self):
+        def _get_custom_dimensions(self, property_id: Optional[str] = None):
             """Returns custom dimensions for the property."""
             try:
-                results_iterator = self.parent.admin_client.list_custom_dimensions(
-                    parent=f"properties/{self.id}")
+                results_iterator = [i for page in self.parent._pages(
+                    self.parent.admin_client.list_custom_dimensions,
+                    {'parent': f"properties/{property_id or self.id}"}) for i in page.custom_dimensions]
             except Exception as e:
                 LOGGER.error(e)
             else:
@@ -286,17 +542,18 @@ class MegatonGA4(object):
                         'parameter_name': i.parameter_name,
                         'display_name': i.display_name,
                         'description': i.description,
-                        'scope': CustomDimension.DimensionScope(i.scope).name,
+                        'scope': ga_admin.CustomDimension.DimensionScope(i.scope).name,
                         # 'disallow_ads_personalization': item.disallow_ads_personalization,
                     }
                     results.append(dict)
                 return results
 
-        def _get_custom_metrics(self):
+        def _get_custom_metrics(self, property_id: Optional[str] = None):
             """Returns custom metrics for the property."""
             try:
-                results_iterator = self.parent.admin_client.list_custom_metrics(
-                    parent=f"properties/{self.id}")
+                results_iterator = [i for page in self.parent._pages(
+                    self.parent.admin_client.list_custom_metrics,
+                    {'parent': f"properties/{property_id or self.id}"}) for i in page.custom_metrics]
             except Exception as e:
                 LOGGER.error(e)
             else:
@@ -306,24 +563,26 @@ class MegatonGA4(object):
                         'parameter_name': i.parameter_name,
                         'display_name': i.display_name,
                         'description': i.description,
-                        'scope': CustomDimension.DimensionScope(i.scope).name,
-                        'measurement_unit': CustomMetric.MeasurementUnit(i.measurement_unit).name,
-                        'restricted_metric_type': [CustomMetric.RestrictedMetricType(d).name for d in
+                        'scope': ga_admin.CustomDimension.DimensionScope(i.scope).name,
+                        'measurement_unit': ga_admin.CustomMetric.MeasurementUnit(i.measurement_unit).name,
+                        'restricted_metric_type': [ga_admin.CustomMetric.RestrictedMetricType(d).name for d in
                                                    i.restricted_metric_type],
                     }
                     results.append(dict)
                 return results
 
-        def _get_data_retention(self):
+        def _get_data_retention(self, property_id: Optional[str] = None):
             """Returns data retention settings for the property."""
+            id = property_id or self.id
             try:
-                item = self.parent.admin_client.get_data_retention_settings(
-                    name=f"properties/{self.id}/dataRetentionSettings")
+                item = self.parent._call(
+                    self.parent.admin_client.get_data_retention_settings,
+                    name=f"properties/{id}/dataRetentionSettings")
             except Exception as e:
                 LOGGER.error(e)
             else:
                 dict = {
-                    'data_retention': DataRetentionSettings.RetentionDuration(item.event_data_retention).name,
+                    'data_retention': ga_admin.DataRetentionSettings.RetentionDuration(item.event_data_retention).name,
                     'reset_user_data_on_new_activity': item.reset_user_data_on_new_activity,
                 }
                 return dict
@@ -353,16 +612,22 @@ class MegatonGA4(object):
             self.data_retention = dict.get('data_retention', '')
             self.data_retention_reset_on_activity = dict.get('data_retention_reset_on_activity', '')
             if not self.data_retention:
-                dict2 = self._get_data_retention()
-                dict['data_retention'] = dict2['data_retention']
-                dict['data_retention_reset_on_activity'] = dict2['reset_user_data_on_new_activity']
+                if self.parent.account._fetch_details(dict).get('data_retention'):
+                    self.parent.account._save()
+                self.data_retention = dict.get('data_retention', '')
+                self.data_retention_reset_on_activity = dict.get('data_retention_reset_on_activity', '')
             self.time_zone = dict.get('time_zone', None)  # GA4 only
             self.currency = dict.get('currency', None)  # GA4 only
             return dict
 
         def get_available(self):
             if not self.api_metadata:
-                self.api_metadata = self._get_metadata()
+                key = self.parent._cache_key('metadata', self.id)
+                self.api_metadata = self.parent.cache.get(key)
+                if not self.api_metadata:
+                    self.api_metadata = self._get_metadata()
+                    if self.api_metadata:
+                        self.parent.cache.set(key, self.api_metadata)
             return self.api_metadata
 
         def get_dimensions(self):
@@ -399,7 +664,7 @@ class MegatonGA4(object):
                             dict['scope'] = c['scope']
                             dict['unit'] = c['measurement_unit']
                 if 'type' in m.keys():
-                    dict['type'] = MetricType(m['type']).name
+                    dict['type'] = ga_data.MetricType(m['type']).name
                 new.append(dict)
             self.metrics = new
             return self.metrics
@@ -471,7 +736,7 @@ class MegatonGA4(object):
                         'parameter_name': parameter_name,
                         'display_name': display_name,
                         'description': description,
-                        'scope': CustomDimension.DimensionScope[scope].value,
+                        'scope': ga_admin.CustomDimension.DimensionScope[scope].value,
                     }
                 )
                 return created_cd
@@ -484,11 +749,89 @@ class MegatonGA4(object):
             self.start_date = '7daysAgo'
             self.end_date = 'yesterday'
             self.segment = None
+            self.bigquery = None
 
         def set_dates(self, start_date: str, end_date: str):
             self.start_date = start_date.strip()
             self.end_date = end_date.strip()
 
+        def set_bigquery(self, megaton_bq, dataset: str, table: str = 'events_*', fields: Optional[dict] = None):
+            """Use the BigQuery export of the property for reports run with backend='bigquery'
+            Args:
+                megaton_bq (bq.Megaton): BigQuery client for the project of the export
+                dataset (str): dataset of the export such as 'analytics_123456789'
+                table (str): 'events_*' for the raw export, or the clean table of bq.Megaton.ForGA4
+                fields (dict): SQL expression for each api_name, required for columns of the clean table
+            """
+            megaton_bq.dataset.select(dataset)
+            self.bigquery = {'client': megaton_bq, 'table': table, 'fields': fields}
+
+        def _parse_conditions(self, conditions: Optional[str]):
+            """Split a legacy filter into a list of (api_name, operator, value)"""
+            result = []
+            for condition in conditions.split(';') if conditions else []:
+                m = re.search(r'^([\w_\+\/\(\) ]+)(==|!=|=@|!@|=~|!~|>=|<=|>|<)(.+)$', condition)
+                if not m:
+                    raise errors.BadRequest(f"Invalid Filter: '{condition}'")
+                result.append((self._format_name(m.groups()[0])[0], m.groups()[1], m.groups()[2]))
+            return result
+
+        def _run_bigquery(self, dimensions: list, metrics: list, periods: list, **kwargs):
+            """Get report data from the BigQuery export instead of the Data API"""
+            if not self.bigquery:
+                raise errors.BadRequest("Call report.set_bigquery() before using the BigQuery backend.")
+            order_bys = kwargs.get('order_bys')
+            if order_bys:
+                order_bys = ','.join(
+                    ('-' if o.strip().startswith('-') else '') + self._format_name(o.strip().lstrip('-'))[0]
+                    for o in order_bys.split(','))
+            args = dict(
+                dimension_filter=self._parse_conditions(kwargs.get('dimension_filter')),
+                metric_filter=self._parse_conditions(kwargs.get('metric_filter')),
+                order_bys=order_bys,
+                limit=kwargs.get('bq_limit'),
+                table=self.bigquery['table'],
+                fields=self.bigquery['fields'],
+            )
+            dimension_api_names = [self._format_name(d)[0] for d in dimensions]
+            metric_api_names = [self._format_name(m)[0] for m in metrics]
+
+            def convert(df, name=None):
+                df.columns = dimensions + metrics
+                if len(periods) > 1:
+                    df.insert(len(dimensions), 'dateRange', name)
+                return utils.change_column_type(df)
+
+            writer = self._get_writer(kwargs)
+            frames = []
+            for start_date, end_date, name in periods:
+                LOGGER.info(f"Querying BigQuery ({start_date} - {end_date})")
+                if writer:
+                    writer.flush()
+                    writer.convert = lambda df, name=name: convert(df, name)
+                    self.bigquery['client'].for_ga4.run_report(
+                        dimension_api_names, metric_api_names, start_date, end_date, writer=writer, **args)
+                else:
+                    frames.append(convert(self.bigquery['client'].for_ga4.run_report(
+                        dimension_api_names, metric_api_names, start_date, end_date, **args), name))
+            if writer:
+                dataset = writer.close()
+                LOGGER.info(f"All {writer.rows} rows were written to {writer.path}")
+                return dataset
+            df = pd.concat(frames, ignore_index=True)
+            LOGGER.info(f"All {len(df)} rows were retrieved.")
+            return df
+
+        def _get_writer(self, kwargs: dict, convert=None):
+            """Return a ParquetSpill if the report should be written to Parquet"""
+            if kwargs.get('to_parquet'):
+                return spill.ParquetSpill(
+                    kwargs['to_parquet'],
+                    memory_budget=kwargs.get('memory_budget'),
+                    partition_cols=kwargs.get('partition_cols'),
+                    convert=convert,
+                    overwrite=kwargs.get('overwrite', False))
+
         def _format_name(self, name: str):
             """Convert api_name or display_name of valid dimensions or metrics to an api_name
             Args:
@@ -512,27 +855,27 @@ class MegatonGA4(object):
 
             if is_dimension:
                 if operator.endswith('='):
-                    return Filter.StringFilter.MatchType.EXACT
+                    return ga_data.Filter.StringFilter.MatchType.EXACT
                 elif operator.endswith('~'):
-                    return Filter.StringFilter.MatchType.PARTIAL_REGEXP
+                    return ga_data.Filter.StringFilter.MatchType.PARTIAL_REGEXP
                 else:
-                    return Filter.StringFilter.MatchType.CONTAINS
+                    return ga_data.Filter.StringFilter.MatchType.CONTAINS
             else:  # is metric
                 if operator.endswith('='):
-                    return Filter.NumericFilter.Operation.EQUAL
+                    return ga_data.Filter.NumericFilter.Operation.EQUAL
                 elif operator == '>':
-                    return Filter.NumericFilter.Operation.GREATER_THAN
+                    return ga_data.Filter.NumericFilter.Operation.GREATER_THAN
                 elif operator == '>=':
-                    return Filter.NumericFilter.Operation.GREATER_THAN_OR_EQUAL
+                    return ga_data.Filter.NumericFilter.Operation.GREATER_THAN_OR_EQUAL
                 elif operator == '<':
-                    return Filter.NumericFilter.Operation.LESS_THAN
+                    return ga_data.Filter.NumericFilter.Operation.LESS_THAN
                 elif operator == '<=':
-                    return Filter.NumericFilter.Operation.LESS_THAN_OR_EQUAL
-                return Filter.NumericFilter.Operation.OPERATION_UNSPECIFIED
+                    return ga_data.Filter.NumericFilter.Operation.LESS_THAN_OR_EQUAL
+                return ga_data.Filter.NumericFilter.Operation.OPERATION_UNSPECIFIED
 
         def _parse_filter_condition(self, condition: str):
             """Convert a single legacy filter format from Core Reporting API v3 to FilterExpression object"""
-            m = re.search(r'^([\w_\+\/\(\) ]+)(==|!=|=@|!@|=~|!~|>|>=|<|<=)(.+)$', condition)
+            m = re.search(r'^([\w_\+\/\(\) ]+)(==|!=|=@|!@|=~|!~|>=|<=|>|<)(.+)$', condition)
             if not m:
                 raise errors.BadRequest(f"Invalid Filter: '{condition}'")
             field, type = self._format_name(m.groups()[0])
@@ -542,33 +885,33 @@ class MegatonGA4(object):
             operator = self._parse_operator(op, type)
 
             if type == 'dimensions':
-                filter = Filter(
+                filter = ga_data.Filter(
                     field_name=field,
-                    string_filter=Filter.StringFilter(
+                    string_filter=ga_data.Filter.StringFilter(
                         match_type=operator,
                         value=value,
                     )
                 )
             elif type == 'metrics':
                 if utils.is_integer(value):
-                    value_class = NumericValue(int64_value=int(float(value)))
+                    value_class = ga_data.NumericValue(int64_value=int(float(value)))
                 else:
-                    value_class = NumericValue(double_value=float(value))
-                filter = Filter(
+                    value_class = ga_data.NumericValue(double_value=float(value))
+                filter = ga_data.Filter(
                     field_name=field,
-                    numeric_filter=Filter.NumericFilter(
+                    numeric_filter=ga_data.Filter.NumericFilter(
                         operation=operator,
                         value=value_class,
                     )
                 )
             if is_not:
-                return FilterExpression(
-                    not_expression=FilterExpression(
+                return ga_data.FilterExpression(
+                    not_expression=ga_data.FilterExpression(
                         filter=filter
                     )
                 )
             else:
-                return FilterExpression(filter=filter)
+                return ga_data.FilterExpression(filter=filter)
 
         def _format_filter(self, conditions):
             """Convert legacy filters format from Core Reporting API v3 to Filter object"""
@@ -579,8 +922,8 @@ class MegatonGA4(object):
             if len(expressions) == 1:
                 return expressions[0]
             else:
-                return FilterExpression(
-                    and_group=FilterExpressionList(
+                return ga_data.FilterExpression(
+                    and_group=ga_data.FilterExpressionList(
                         expressions=expressions
                     )
                 )
@@ -638,9 +981,9 @@ class MegatonGA4(object):
                 if self._format_name(field):
                     # DIMENSION
                     result.append(
-                        OrderBy(
+                        ga_data.OrderBy(
                             desc=desc,
-                            dimension=OrderBy.DimensionOrderBy(
+                            dimension=ga_data.OrderBy.DimensionOrderBy(
                                 dimension_name=field
                             )
                         )
@@ -648,9 +991,9 @@ class MegatonGA4(object):
                 elif self._format_name(field):
                     # METRIC
                     result.append(
-                        OrderBy(
+                        ga_data.OrderBy(
                             desc=desc,
-                            metric=OrderBy.MetricOrderBy(
+                            metric=ga_data.OrderBy.MetricOrderBy(
                                 metric_name=field
                             )
                         )
@@ -667,20 +1010,23 @@ class MegatonGA4(object):
             metric_aggregations = []
             if kwargs.get('show_total', False):
                 metric_aggregations = [
-                    MetricAggregation.TOTAL,
-                    MetricAggregation.MAXIMUM,
-                    MetricAggregation.MINIMUM,
+                    ga_data.MetricAggregation.TOTAL,
+                    ga_data.MetricAggregation.MAXIMUM,
+                    ga_data.MetricAggregation.MINIMUM,
                 ]
 
-            return RunReportRequest(
+            date_ranges = kwargs.get('date_ranges') or [(kwargs.get('start_date'), kwargs.get('end_date'))]
+
+            return ga_data.RunReportRequest(
                 property=f"properties/{self.parent.property.id}",
-                date_ranges=[DateRange(
-                    start_date=kwargs.get('start_date'),
-                    end_date=kwargs.get('end_date')
-                )],
-                dimensions=[Dimension(name=d) for d in dimension_api_names],
+                date_ranges=[ga_data.DateRange(
+                    start_date=r[0],
+                    end_date=r[1],
+                    name=r[2] if len(r) > 2 else None,
+                ) for r in date_ranges],
+                dimensions=[ga_data.Dimension(name=d) for d in dimension_api_names],
                 dimension_filter=self._format_filter(kwargs.get('dimension_filter')),
-                metrics=[Metric(name=m) for m in metrics_api_names],
+                metrics=[ga_data.Metric(name=m) for m in metrics_api_names],
                 metric_filter=self._format_filter(kwargs.get('metric_filter')),
                 order_bys=self._format_order_bys(kwargs.get('order_bys')),
                 metric_aggregations=metric_aggregations,
@@ -704,7 +1050,7 @@ class MegatonGA4(object):
 
             for i in response.metric_headers:
                 names.append(i.name)
-                metric_types.append(MetricType(i.type_).name)
+                metric_types.append(ga_data.MetricType(i.type_).name)
 
             for row in response.rows:
                 row_data = []
@@ -721,35 +1067,206 @@ class MegatonGA4(object):
 
             return all_data, names, dimension_types + metric_types
 
-        def _request_report_api(self, offset: int, request: dict):
+        def _format_df(self, df: pd.DataFrame, request, dimensions: list, metrics: list):
+            """Convert column types and rename columns of API names to the names requested"""
+            df = utils.change_column_type(df)
+            # the API adds dateRange dimension when multiple date ranges are requested
+            api_names = [d.name for d in request.dimensions] + [m.name for m in request.metrics]
+            return df.rename(columns=dict(zip(api_names, dimensions + metrics)))
+
+        def _format_date_ranges(self, date_ranges):
+            """Convert date ranges to a list of (start_date, end_date, name)
+
+            Args:
+                date_ranges (dict or list): {name: (start_date, end_date)}, or a list of
+                    (start_date, end_date) or (start_date, end_date, name)
+            """
+            if isinstance(date_ranges, dict):
+                date_ranges = [(s, e, n) for n, (s, e) in date_ranges.items()]
+            formatted = []
+            for i, r in enumerate(date_ranges):
+                start_date, end_date = r[0], r[1]
+                name = r[2] if len(r) > 2 and r[2] else f"date_range_{i}"
+                formatted.append((start_date, end_date, name))
+            if len(formatted) > constants.GA4_MAX_DATE_RANGES:
+                raise errors.BadRequest(f"Up to {constants.GA4_MAX_DATE_RANGES} date ranges are allowed.")
+            return formatted
+
+        def _to_wide(self, df: pd.DataFrame, dimensions: list, metrics: list, range_names: list):
+            """Pivot a report with dateRange column so that each metric has a column per date range"""
+            index = dimensions or [df.assign(_all=0)['_all']]
+            df = df.pivot_table(
+                index=index, columns='dateRange', values=metrics, aggfunc='sum', fill_value=0, observed=True)
+            df = df.reindex(columns=[(m, n) for m in metrics for n in range_names], fill_value=0)
+            df.columns = [f"{m}_{n}" for m, n in df.columns]
+            return df.reset_index() if dimensions else df.reset_index(drop=True)
+
+        def _run_report_raw(self, request, timeout: Optional[float] = None):
+            """Call RunReport and return the serialized response without parsing it"""
+            channel = self.parent.data_client.transport.grpc_channel
+            stub = channel.unary_unary(
+                '/google.analytics.data.v1beta.BetaAnalyticsData/RunReport',
+                request_serializer=ga_data.RunReportRequest.serialize,
+                response_deserializer=None,
+            )
+            if self.parent.rate_limiter:
+                self.parent.rate_limiter.acquire()
+            try:
+                return stub(request, timeout=timeout, metadata=[('x-goog-request-params', f"property={request.property}")])
+            except grpc.RpcError as e:
+                raise api_exceptions.from_grpc_error(e) from e
+
+        def _request_report_api(self, offset: int, request: dict, deadline: Optional[retry.Deadline] = None,
+                                decoder: Optional[ProcessPoolExecutor] = None, categorical: bool = False):
+            """Return a page, or a Future of it while the response is decoded by the decoder"""
             if offset:
-                request.offset = offset
+                request = ga_data.RunReportRequest(request, offset=offset)
 
-            total_rows, response = 0, None
             try:
-                response = self.parent.data_client.run_report(request)
-                total_rows = response.row_count
-            except PermissionDenied as e:
+                if decoder and hasattr(self.parent.data_client.transport, 'grpc_channel'):
+                    payload = self.parent.retry_policy.call(self._run_report_raw, request, deadline=deadline)
+                    return decoder.submit(decode_report_page, payload, categorical)
+                response = self.parent._call(self.parent.data_client.run_report, request, deadline=deadline)
+            except api_exceptions.PermissionDenied as e:
                 LOGGER.error("権限がありません。")
                 message = getattr(e, 'message', repr(e))
-                ex_value = sys.exc_info()[1]
-                m = re.search(r'reason: "([^"]+)', str(ex_value))
-                if m:
-                    reason = m.group(1)
-                    if reason == 'SERVICE_DISABLED':
-                        LOGGER.error("GCPのプロジェクトでData APIを有効化してください。")
-                LOGGER.warn(message)
-            except Exception as e:
-                type_, value, traceback_ = sys.exc_info()
-                LOGGER.debug(type_)
-                LOGGER.debug(value)
+                m = re.search(r'reason: "([^"]+)', str(e))
+                if m and m.group(1) == 'SERVICE_DISABLED':
+                    LOGGER.error("GCPのプロジェクトでData APIを有効化してください。")
+                    raise errors.ApiDisabled(message) from e
+                raise errors.BadPermission(message) from e
+
+            if categorical:
+                return decode_response(ga_data.RunReportResponse.pb(response), categorical=True)
 
             data, headers, types = self._parse_response(response)
 
-            return data, total_rows, headers, types
+            return data, response.row_count, headers, types
+
+        def _start_page(self, offset: int, request, ckpt: Optional[checkpoint.Checkpoint] = None,
+                        deadline: Optional[retry.Deadline] = None, decoder: Optional[ProcessPoolExecutor] = None,
+                        categorical: bool = False):
+            """Request a page and return a function that returns it.
+            With a decoder, the page is decoded in another process until the function is called."""
+            if ckpt and ckpt.has(offset):
+                info = ckpt.info
+                page = ckpt.load(offset), info['total_rows'], info['headers'], info['types']
+                return lambda: page
+
+            response = self._request_report_api(offset, request, deadline, decoder, categorical)
+
+            def result():
+                data, total_rows, headers, types = response.result() if isinstance(response, Future) else response
+                if ckpt and len(data):
+                    if not ckpt.info:
+                        ckpt.update(total_rows=total_rows, headers=headers, types=types)
+                    ckpt.save(offset, data)
+                return data, total_rows, headers, types
+            return result
+
+        def _fetch_page(self, offset: int, request, ckpt: Optional[checkpoint.Checkpoint] = None,
+                        deadline: Optional[retry.Deadline] = None, decoder: Optional[ProcessPoolExecutor] = None,
+                        categorical: bool = False):
+            """Return a page from the checkpoint if it was saved, otherwise request it to API"""
+            return self._start_page(offset, request, ckpt, deadline, decoder, categorical)()
+
+        def _iter_pages(self, request, limit: int, ckpt: Optional[checkpoint.Checkpoint] = None,
+                        deadline: Optional[retry.Deadline] = None, workers: int = 1,
+                        decoder: Optional[ProcessPoolExecutor] = None, categorical: bool = False):
+            """Yield offset and page of a report in order.
+            Pages after the first one are fetched by multiple threads when workers > 1."""
+            page = self._fetch_page(0, request, ckpt, deadline, decoder, categorical)
+            yield 0, page
+            data, total_rows = page[0], page[1]
+            if not len(data):
+                return
+
+            if workers > 1:
+                offsets = list(range(limit, total_rows, limit))
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    futures = [executor.submit(self._fetch_page, o, request, ckpt, deadline, decoder, categorical)
+                               for o in offsets]
+                    try:
+                        for offset, future in zip(offsets, futures):
+                            yield offset, future.result()
+                    finally:
+                        for future in futures:
+                            future.cancel()
+                return
+
+            # the next page is requested while the decoder is still working on the current one
+            offset, result = None, None
+            for next_offset in range(limit, total_rows, limit):
+                try:
+                    next_result = self._start_page(next_offset, request, ckpt, deadline, decoder, categorical)
+                except Exception:
+                    if result:
+                        yield offset, result()
+                    raise
+                if result:
+                    page = result()
+                    yield offset, page
+                    if not len(page[0]):
+                        return
+                offset, result = next_offset, next_result
+            if result:
+                yield offset, result()
+
+        def _page_to_df(self, data, headers: list):
+            """Convert a page of rows or an Arrow table to DataFrame"""
+            if isinstance(data, list):
+                return pd.DataFrame(data, columns=headers)
+            return data.to_pandas()
+
+        def _pages_to_df(self, pages: list, headers: list):
+            """Combine pages into a DataFrame, merging dictionaries of encoded columns"""
+            if all(not isinstance(d, list) for d in pages):
+                try:
+                    return pa.concat_tables(pages, promote_options='permissive').unify_dictionaries().to_pandas()
+                except (pa.ArrowInvalid, pa.ArrowTypeError):
+                    LOGGER.debug("pages have different types and are combined by pandas")
+            return pd.concat([self._page_to_df(d, headers) for d in pages], ignore_index=True)
+
+        def _page_to_rows(self, data):
+            """Convert a page of rows or an Arrow table to a list of rows"""
+            if isinstance(data, list):
+                return data
+            return [list(r) for r in zip(*[c.to_pylist() for c in data.columns])]
 
         def run(self, dimensions: list, metrics: list, to_pd: bool = True, **kwargs):
-            """Get Analytics report data"""
+            """Get Analytics report data
+
+            Args:
+                dimensions (list): api_name or display_name of dimensions
+                metrics (list): api_name or display_name of metrics
+                to_pd (bool): return a DataFrame, or a tuple of rows, headers and types if False
+                checkpoint_dir (str): save each page to this directory so that a rerun resumes from the first missing page
+                deadline (float): seconds allowed for the whole report including retries
+                date_ranges (dict or list): up to 4 periods to compare in one request, such as
+                    {'this_week': ('7daysAgo', 'yesterday'), 'last_week': ('14daysAgo', '8daysAgo')}.
+                    start_date and end_date are ignored when given. A dateRange column holding the name is added.
+                wide (bool): with date_ranges, return a column for each metric and date range
+                    instead of a row for each date range
+                backend (str): 'api' (default) or 'bigquery' to aggregate the BigQuery export set by set_bigquery().
+                    Reports are not limited in rows, sampled or thresholded, so long periods and
+                    high-cardinality dimensions are cheaper. bq_limit caps rows of the query.
+                to_parquet (str): write rows to a Parquet dataset in this directory as they arrive
+                    and return a pyarrow dataset to read lazily instead of the data
+                memory_budget (int): bytes of rows to keep in memory before writing them with to_parquet
+                partition_cols (list): columns to partition the Parquet dataset by
+                overwrite (bool): allow to_parquet to be a directory with files, replacing Parquet files
+                    of an earlier run in it
+                workers (int): number of pages to request at the same time after the first page
+                processes (int): decode responses in this number of processes instead of the main one,
+                    so that the next page is fetched while others are decoded. The processes are spawned,
+                    so a script using this needs the `if __name__ == '__main__':` guard.
+                categorical (bool): dictionary-encode dimension values while decoding and return them as
+                    categorical columns. Each distinct value is kept once, which saves memory on large reports.
+
+            Raises:
+                errors.IncompleteReport: when a page fails or comes back empty before all rows were retrieved.
+                    The rows retrieved so far are kept in the exception.
+            """
             if not self.parent.property.id:
                 LOGGER.error("Propertyを先に選択してから実行してください。")
                 return
@@ -764,13 +1281,28 @@ class MegatonGA4(object):
             limit = kwargs.get('limit', 10000)
             start_date = kwargs.get('start_date', self.start_date)
             end_date = kwargs.get('end_date', self.end_date)
-            LOGGER.info(f"Requesting a report ({start_date} - {end_date})")
+            date_ranges = None
+            if kwargs.get('date_ranges'):
+                date_ranges = self._format_date_ranges(kwargs['date_ranges'])
+                LOGGER.info("Requesting a report (" + ", ".join(f"{n}: {s} - {e}" for s, e, n in date_ranges) + ")")
+            else:
+                LOGGER.info(f"Requesting a report ({start_date} - {end_date})")
+
+            if kwargs.get('backend', 'api') == 'bigquery':
+                df = self._run_bigquery(
+                    dimensions, metrics, date_ranges or [(start_date, end_date, None)], **kwargs)
+                if kwargs.get('to_parquet'):
+                    return df
+                if date_ranges and kwargs.get('wide'):
+                    df = self._to_wide(df, dimensions, metrics, [r[2] for r in date_ranges])
+                return df if to_pd else (df.values.tolist(), list(df.columns), None)
 
             request = self._format_request(
                 dimensions=dimensions,
                 metrics=metrics,
                 start_date=start_date,
                 end_date=end_date,
+                date_ranges=date_ranges,
                 dimension_filter=kwargs.get('dimension_filter'),
                 metric_filter=kwargs.get('metric_filter'),
                 order_bys=kwargs.get('order_bys'),
@@ -779,37 +1311,92 @@ class MegatonGA4(object):
             )
             # print(request)
 
-            all_rows, offset, page = [], 0, 1
-            while True:
-                (data, total_rows, headers, types) = self._request_report_api(offset, request)
-                if len(data) > 0:
-                    all_rows.extend(data)
+            ckpt = None
+            if kwargs.get('checkpoint_dir'):
+                ckpt = checkpoint.Checkpoint(
+                    kwargs['checkpoint_dir'],
+                    ga_data.RunReportRequest.to_json(request),
+                    dates=[d for r in date_ranges for d in r[:2]] if date_ranges else [start_date, end_date])
+
+            writer = self._get_writer(kwargs, lambda df: self._format_df(df, request, dimensions, metrics))
+            deadline = retry.Deadline(kwargs.get('deadline'))
+            decoder = None
+            if kwargs.get('processes'):
+                # forking a process with gRPC threads running can deadlock
+                decoder = ProcessPoolExecutor(max_workers=kwargs['processes'],
+                                              mp_context=multiprocessing.get_context('spawn'))
+            pages = self._iter_pages(
+                request, limit, ckpt, deadline, kwargs.get('workers', 1), decoder, kwargs.get('categorical', False))
+            all_pages, rows, page, total_rows = [], 0, 1, 0
+            headers, types = [], []
+            try:
+                while True:
+                    try:
+                        offset, (data, total_rows, headers, types) = next(pages)
+                    except StopIteration:
+                        break
+                    except Exception as e:
+                        if not rows:
+                            raise
+                        LOGGER.error(f"p{page} failed: {rows} rows were retrieved before the error.")
+                        if writer:
+                            writer.close()
+                        raise errors.IncompleteReport(
+                            f"Report stopped at row #{rows + 1}: {e}",
+                            data=[r for d in all_pages for r in self._page_to_rows(d)],
+                            headers=headers, types=types) from e
+                    if not len(data):
+                        # an empty page before the end is checked below
+                        break
+                    if writer:
+                        if isinstance(data, list):
+                            writer.columns = headers
+                            writer.append(data)
+                        else:
+                            writer.append_df(data.to_pandas())
+                    else:
+                        all_pages.append(data)
                     if offset == 0:
                         LOGGER.info(f"Total {total_rows} rows found.")
                     LOGGER.info(f" p{page}: retrieved #{offset + 1} - {offset + len(data)}")
-                    if offset + len(data) == total_rows:
-                        break
-                    else:
-                        page += 1
-                        offset += limit
-                else:
-                    break
-
-            if len(all_rows) > 0:
-                LOGGER.info(f"All {len(all_rows)} rows were retrieved.")
+                    rows += len(data)
+                    page += 1
+                    if rows == total_rows and ckpt:
+                        ckpt.finish()
+                if rows < total_rows:
+                    LOGGER.error(f"p{page} was empty: {rows} of {total_rows} rows were retrieved.")
+                    if writer:
+                        writer.close()
+                    raise errors.IncompleteReport(
+                        f"Report stopped at row #{rows + 1} of {total_rows}: an empty page was returned",
+                        data=[r for d in all_pages for r in self._page_to_rows(d)],
+                        headers=headers, types=types)
+            finally:
+                pages.close()
+                if decoder:
+                    decoder.shutdown(cancel_futures=True)
+
+            if writer:
+                dataset = writer.close()
+                LOGGER.info(f"All {writer.rows} rows were written to {writer.path}")
+                return dataset
+
+            if rows > 0:
+                LOGGER.info(f"All {rows} rows were retrieved.")
                 if to_pd:
-                    df = pd.DataFrame(all_rows, columns=headers)
-                    df = utils.change_column_type(df)
-                    df.columns = dimensions + metrics
+                    df = self._pages_to_df(all_pages, headers)
+                    df = self._format_df(df, request, dimensions, metrics)
+                    if date_ranges and 'dateRange' in df.columns and kwargs.get('wide'):
+                        df = self._to_wide(df, dimensions, metrics, [r[2] for r in date_ranges])
                     return df
                 else:
-                    return all_rows, headers, types
+                    return [r for d in all_pages for r in self._page_to_rows(d)], headers, types
             else:
                 LOGGER.warn("no data found.")
                 if to_pd:
                     return pd.DataFrame()
                 else:
-                    return all_rows, headers, types
+                    return [], headers, types
 
         """
         pre-defined reports
@@ -870,16 +1457,16 @@ class MegatonGA4(object):
             metrics = [
                 'eventCount',
             ]
-            dimension_filter = FilterExpression(
-                filter=Filter(
+            dimension_filter = ga_data.FilterExpression(
+                filter=ga_data.Filter(
                     field_name="eventName",
-                    string_filter=Filter.StringFilter(value="page_view"),
+                    string_filter=ga_data.Filter.StringFilter(value="page_view"),
                 )
             )
             order_bys = [
-                OrderBy(
+                ga_data.OrderBy(
                     desc=False,
-                    dimension=OrderBy.DimensionOrderBy(
+                    dimension=ga_data.OrderBy.DimensionOrderBy(
                         dimension_name="date"
                     )
                 ),
@@ -900,15 +1487,15 @@ class MegatonGA4(object):
                 'eventCount',
             ]
             order_bys = [
-                OrderBy(
+                ga_data.OrderBy(
                     desc=False,
-                    dimension=OrderBy.DimensionOrderBy(
+                    dimension=ga_data.OrderBy.DimensionOrderBy(
                         dimension_name="date"
                     )
                 ),
-                OrderBy(
+                ga_data.OrderBy(
                     desc=True,
-                    metric=OrderBy.MetricOrderBy(
+                    metric=ga_data.OrderBy.MetricOrderBy(
                         metric_name="eventCount"
                     )
                 ),
@@ -928,16 +1515,16 @@ class MegatonGA4(object):
             metrics = [
                 'eventCount',
             ]
-            # dimension_filter = FilterExpression(
-            #     filter=Filter(
+            # dimension_filter = ga_data.FilterExpression(
+            #     filter=ga_data.Filter(
             #         field_name="eventName",
-            #         string_filter=Filter.StringFilter(value="page_view"),
+            #         string_filter=ga_data.Filter.StringFilter(value="page_view"),
             #     )
             # )
             order_bys = [
-                OrderBy(
+                ga_data.OrderBy(
                     desc=False,
-                    dimension=OrderBy.DimensionOrderBy(
+                    dimension=ga_data.OrderBy.DimensionOrderBy(
                         dimension_name="date"
                     )
                 ),
@@ -992,3 +1579,47 @@ def convert_proto_datetime(dt):
             dt.timestamp(),
             pytz.timezone('Asia/Tokyo')
         )
+
+
+def decode_response(response, categorical: bool = False):
+    """Decode rows of RunReportResponse protobuf message into an Arrow table
+
+    Args:
+        response: RunReportResponse as a protobuf message (not proto-plus)
+        categorical (bool): dictionary-encode dimension values so that each distinct value is stored once
+    Returns:
+        Arrow table, total rows, headers and types like Report._request_report_api
+    """
+    names, types, columns = [], [], []
+    for i, h in enumerate(response.dimension_headers):
+        names.append(h.name)
+        types.append('category')
+        values = (row.dimension_values[i].value for row in response.rows)
+        if categorical:
+            index = {}
+            codes = array('i', (index.setdefault(v, len(index)) for v in values))
+            columns.append(pa.DictionaryArray.from_arrays(
+                pa.array(codes, type=pa.int32()), pa.array(list(index), type=pa.string())))
+        else:
+            columns.append(pa.array(list(values), type=pa.string()))
+    for i, h in enumerate(response.metric_headers):
+        type = ga_data.MetricType(h.type_).name
+        names.append(h.name)
+        types.append(type)
+        values = [row.metric_values[i].value for row in response.rows]
+        kind = type.replace('TYPE_', '')
+        try:
+            if kind in ['INTEGER', 'HOURS', 'MINUTES', 'SECONDS', 'MILLISECONDS']:
+                values = pa.array([int(v) for v in values], type=pa.int64())
+            elif kind in ['FLOAT']:
+                values = pa.array([float(v) for v in values], type=pa.float64())
+        except ValueError:
+            pass
+        columns.append(values if isinstance(values, pa.Array) else pa.array(values, type=pa.string()))
+    return pa.Table.from_arrays(columns, names=names), response.row_count, names, types
+
+
+def decode_report_page(payload: bytes, categorical: bool = False):
+    """Decode a serialized RunReportResponse into an Arrow table.
+    Runs in a worker process so that parsing rows does not hold the GIL of the main process."""
+    return decode_response(ga_data.RunReportResponse.pb().FromString(payload), categorical)
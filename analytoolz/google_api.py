@@ -2,23 +2,95 @@
 Functions for Google API
 """
 
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Optional
 import json
 import logging
 import os
+import threading
 import time
 
-from googleapiclient import errors
-from googleapiclient.discovery import build, DISCOVERY_URI
-from google.oauth2 import service_account
 from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
+
+from . import cache, constants, ratelimit, retry, utils
+
+# heavy client libraries are imported when an API is first used
+discovery = utils.lazy_import('googleapiclient.discovery')
+errors = utils.lazy_import('googleapiclient.errors')
+flow = utils.lazy_import('google_auth_oauthlib.flow')
+google_auth_httplib2 = utils.lazy_import('google_auth_httplib2')
+httplib2 = utils.lazy_import('httplib2')
+service_account = utils.lazy_import('google.oauth2.service_account')
 
 _REQUIRED_CONFIG_KEYS = frozenset(("auth_uri", "token_uri", "client_id"))
 
+# seconds until a discovery document saved in the cache is downloaded again
+DISCOVERY_CACHE_TTL = 7 * 86400
+
+_DISCOVERY_CACHES = {}
+_DISCOVERY_CACHES_LOCK = threading.Lock()
+
+
+def _client_version():
+    try:
+        from importlib.metadata import version
+        return version('google-api-python-client')
+    except Exception:  # noqa
+        return ''
+
+
+class DiscoveryCache(object):
+    """Cache of discovery documents for googleapiclient, kept in memory and optionally in a directory.
+    Documents are saved for each version of googleapiclient, so that a document of another version is not reused.
+
+    Args:
+        path (str): directory to save documents. Documents are kept only in memory if omitted.
+        ttl (int): seconds until a document expires
+    """
+
+    def __init__(self, path: Optional[str] = None, ttl: int = DISCOVERY_CACHE_TTL):
+        """constructor"""
+        self._cache = cache.DiskCache(path, ttl=ttl)
+        self._version = _client_version()
+
+    def _key(self, url: str):
+        return f"discovery:{self._version}:{url}"
+
+    def get(self, url):
+        return self._cache.get(self._key(url))
+
+    def set(self, url, content):
+        self._cache.set(self._key(url), content)
+
+
+def get_discovery_cache(path: Optional[str] = None):
+    """Return the discovery cache shared in this process for the directory"""
+    with _DISCOVERY_CACHES_LOCK:
+        if path not in _DISCOVERY_CACHES:
+            _DISCOVERY_CACHES[path] = DiscoveryCache(path)
+        return _DISCOVERY_CACHES[path]
+
 
 class GoogleApi(object):
-    """Google API helper object"""
+    """Google API helper object
+
+    Every request waits for a token bucket shared by all threads calling the same API with the same project,
+    and temporary errors including rate limits are retried a limited number of times.
+
+    httplib2 is not thread-safe, so each thread gets its own service and HTTP transport.
+    They share the credentials, which are refreshed by one thread at a time.
+
+    Args:
+        rate_limiter (RateLimiter): limiter to pass every request through
+        rate_limit (float): requests per second for the shared limiter used when rate_limiter is not given.
+            Defaults to constants.API_RATE_LIMITS. 0 disables it.
+        retry_policy (RetryPolicy): how to retry requests failing with temporary errors
+        retries (int): retries of the default retry policy
+        retry_budget (RetryBudget): retries shared with other clients
+        static_discovery (bool): use discovery documents which ship with googleapiclient instead of downloading them.
+            Defaults to True unless discovery_url is given. Documents not shipped are downloaded.
+        discovery_cache_dir (str): directory to save downloaded discovery documents in addition to memory
+    """
 
     def __init__(self, api="oauth2", version="v2", scopes=['https://www.googleapis.com/auth/analytics.readonly'], *args,
                  **kwargs):
@@ -27,24 +99,78 @@ class GoogleApi(object):
         self.api_version = version
         self.scopes = scopes
         self.credentials = kwargs.get('credentials')
-        self._service = None
-        self.discovery_url = kwargs.get('discovery_url', DISCOVERY_URI)
-        self.retries = kwargs.get('retries', 3)
+        self._local = threading.local()
+        self._credentials_lock = threading.Lock()
+        self.discovery_url = kwargs.get('discovery_url')
+        self.static_discovery = kwargs.get('static_discovery')
+        self.discovery_cache_dir = kwargs.get('discovery_cache_dir')
+        self.retries = kwargs.get('retries', 5)
         self.credential_cache_file = kwargs.get('credential_cache_file', "creden-cache.json")
         self.cache_dir = kwargs.get('cache_dir', ".")
+        self._rate_limiter = kwargs.get('rate_limiter')
+        self.rate_limit = kwargs.get('rate_limit', constants.API_RATE_LIMITS.get(api))
+        self.retry_policy = kwargs.get('retry_policy') or retry.RetryPolicy(
+            attempts=self.retries + 1, retryable=retry.is_retryable_http_error, budget=kwargs.get('retry_budget'))
+        self.timeout = kwargs.get('timeout')
         self.log = logging.getLogger("__name__")
 
+    @property
+    def project(self):
+        """Project of the credentials, which API quotas are counted for"""
+        for attr in ['quota_project_id', 'project_id', 'client_id', 'service_account_email']:
+            value = getattr(self.credentials, attr, None)
+            if value:
+                return value
+        return ''
+
+    @property
+    def rate_limiter(self):
+        """Limiter given to the constructor, or the one shared by the API and project"""
+        if self._rate_limiter is None and self.rate_limit:
+            return ratelimit.get_limiter(f"{self.api}:{self.project}", self.rate_limit)
+        return self._rate_limiter
+
+    @rate_limiter.setter
+    def rate_limiter(self, value):
+        self._rate_limiter = value
+
     @property
     def service(self):
-        """get or create a api service"""
-        if self._service is None:
+        """get or create a api service for the current thread"""
+        service = getattr(self._local, 'service', None)
+        if service is None:
             # self.log.debug(f"Creating a service for {self.api} API")
-            self._service = build(self.api,
-                                  self.api_version,
-                                  credentials=self.credentials,
-                                  # cache=program_memory_cache,
-                                  discoveryServiceUrl=self.discovery_url)
-        return self._service
+            auth = {'credentials': self.credentials}
+            if self.credentials is not None:
+                auth = {'http': google_auth_httplib2.AuthorizedHttp(
+                    self.credentials, http=httplib2.Http(timeout=self.timeout))}
+            service = self._local.service = self._build(**auth)
+        return service
+
+    def _refresh_credentials(self):
+        """Refresh expired credentials before a request, so that threads do not refresh them at the same time"""
+        credentials = self.credentials
+        if credentials is None or getattr(credentials, 'valid', True):
+            return
+        with self._credentials_lock:
+            if not credentials.valid:
+                self.log.debug("refreshing credentials")
+                credentials.refresh(google_auth_httplib2.Request(httplib2.Http(timeout=self.timeout)))
+
+    def _build(self, **auth):
+        """Build a service from a shipped or cached discovery document if possible"""
+        static = self.static_discovery if self.static_discovery is not None else not self.discovery_url
+        if static:
+            try:
+                return discovery.build(self.api, self.api_version, static_discovery=True, **auth)
+            except errors.UnknownApiNameOrVersion:
+                self.log.debug(f"no static discovery document for {self.api} {self.api_version}")
+        return discovery.build(self.api,
+                               self.api_version,
+                               cache=get_discovery_cache(self.discovery_cache_dir),
+                               discoveryServiceUrl=self.discovery_url or discovery.DISCOVERY_URI,
+                               static_discovery=False,
+                               **auth)
 
     def auth(self, file: str):
         if not os.path.isdir(self.cache_dir):
@@ -54,46 +180,115 @@ class GoogleApi(object):
         credentials = get_credentials(file, self.scopes, cache_path)
 
         self.credentials = credentials
-        self._service = None
+        self._local = threading.local()
         return self
 
-    def retry(self, service_method, retry_count=0):
+    def _execute(self, service_method, **kwargs):
+        """Execute a request after the rate limiter lets it through"""
+        limiter = self.rate_limiter
+        if limiter:
+            limiter.acquire()
+        self._refresh_credentials()
+        return service_method.execute(num_retries=0)
+
+    def retry(self, service_method):
         """
-        retry a google api call and check for rate limits
+        execute a google api call, retrying temporary errors and rate limits within the retry policy
         """
         try:
-            return service_method.execute(num_retries=retry_count)
+            return self.retry_policy.call(self._execute, service_method)
         except errors.HttpError as e:
-            code = e.resp.get('code')
+            data = {}
             reason = ''
             message = ''
             try:
                 data = json.loads(e.content.decode('utf-8'))
-                code = data['error']["code"]
                 message = data['error']['message']
                 reason = data['error']['errors'][0]['reason']
             except:  # noqa
                 pass
 
-            if code == 403 and "rate limit exceeded" in message.lower():
-                self.log.debug("rate limit reached, sleeping for %s seconds", 2 ** retry_count)
-                time.sleep(2 ** retry_count)
-                return self.retry(service_method, retry_count + 1)
-            elif code == 403 and ("accessNotConfigured" in reason or 'disabled' in message):
+            if e.resp.status == 403 and ("accessNotConfigured" in reason or 'disabled' in message):
                 self.log.error(message)
-                raise
+            elif retry.is_retryable_http_error(e):
+                self.log.warning(f"gave up retrying {self.api} API: {message}")
             else:
-                self.log.warn(f"got HttpError (content={data}")
-                raise
-        except BrokenPipeError:
-            self.log.info("BrokenPipeError occurred but attempting to retry")
-            return self.retry(service_method, retry_count + 1)
+                self.log.warning(f"got HttpError (content={data})")
+            raise
         except KeyboardInterrupt:
             raise
         except:  # noqa
             self.log.exception("Failed to execute api method")
             raise
 
+    def _resource(self, path: str):
+        """Return a resource of the service for the current thread such as 'management.webproperties'"""
+        resource = self.service
+        for name in path.split('.'):
+            resource = getattr(resource, name)()
+        return resource
+
+    def list_all(self, path: str, max_workers: int = 4, page_size: int = 1000, **kwargs):
+        """Call list of a resource and return the response with items of all pages
+
+        totalResults of the first page tells which pages remain, and they are requested by start_index
+        at the same time.
+        Args:
+            path (str): resource such as 'management.webproperties'
+            max_workers (int): number of pages to request at the same time
+            page_size (int): items in a page (max_results)
+            kwargs: parameters of the list method
+        """
+        first = self.retry(self._resource(path).list(max_results=page_size, **kwargs))
+        items = list(first.get('items', []))
+        starts = next_page_indexes(first)
+        if starts:
+            def get_page(start: int):
+                return self.retry(self._resource(path).list(max_results=page_size, start_index=start, **kwargs))
+
+            self.log.debug(f"requesting {len(starts)} more pages of {path}")
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                for page in executor.map(get_page, starts):
+                    items.extend(page.get('items', []))
+        return dict(first, items=items)
+
+    def execute_batch(self, requests: dict, batch_size: int = 100):
+        """Execute requests of the service in batches, retrying calls failing with temporary errors
+        Args:
+            requests (dict): requests built from self.service, keyed by anything hashable
+            batch_size (int): calls in a batch request
+        Returns:
+            dict of response, or of the exception for calls that failed, for each key
+        """
+        results = {}
+        pending = dict(requests)
+        for attempt in range(1, self.retry_policy.attempts + 1):
+            failed = {}
+            for chunk in utils.get_chunked_list(list(pending), batch_size):
+                def callback(request_id, response, exception, chunk=chunk):
+                    key = chunk[int(request_id)]
+                    results[key] = exception if exception is not None else response
+                    if exception is not None and self.retry_policy.retryable(exception):
+                        failed[key] = pending[key]
+
+                batch = self.service.new_batch_http_request(callback=callback)
+                for i, key in enumerate(chunk):
+                    batch.add(pending[key], request_id=str(i))
+                limiter = self.rate_limiter
+                for _ in chunk if limiter else []:
+                    limiter.acquire()
+                self._refresh_credentials()
+                self.retry_policy.call(lambda **kwargs: batch.execute())
+            if not failed or attempt == self.retry_policy.attempts:
+                break
+            if self.retry_policy.budget and not self.retry_policy.budget.spend():
+                break
+            wait = self.retry_policy.delay(attempt)
+            self.log.warning(f"retrying {len(failed)} calls of the batch in {wait:.1f}s")
+            time.sleep(wait)
+            pending = failed
+        return results
+
     def __getattr__(self, name):
         """ get attribute or service wrapper
         :param name: attribute / service name
@@ -157,6 +352,15 @@ class MethodHelper(object):
         return MethodHelper(self.google_api, self.service, name, self.path).call
 
 
+def next_page_indexes(response: dict) -> list:
+    """Return start indexes of pages after the first page of a list response"""
+    total = response.get('totalResults') or 0
+    per_page = response.get('itemsPerPage') or len(response.get('items', []))
+    if not per_page:
+        return []
+    return list(range(response.get('startIndex', 1) + per_page, total + 1, per_page))
+
+
 def _is_service_account_json(file: str):
     """Return true if the provided JSON file is for a service account."""
     with open(file, 'r') as f:
@@ -177,25 +381,25 @@ def _is_service_account_key(key_json_text: str):
 def _run_auth_flow(client_secret_file: Optional[str], scopes: List[str], config: Optional[dict] = {}):
     """Run OAuth2 Flow"""
     if os.path.exists(client_secret_file):
-        flow = InstalledAppFlow.from_client_secrets_file(
+        auth_flow = flow.InstalledAppFlow.from_client_secrets_file(
             client_secret_file,
             scopes=scopes,
             redirect_uri="urn:ietf:wg:oauth:2.0:oob"
         )
     else:
         print("JSON not found.")
-        flow = InstalledAppFlow.from_client_config(
+        auth_flow = flow.InstalledAppFlow.from_client_config(
             config,
             scopes=scopes,
             redirect_uri="urn:ietf:wg:oauth:2.0:oob"
         )
-    auth_url, _ = flow.authorization_url(prompt="consent")
+    auth_url, _ = auth_flow.authorization_url(prompt="consent")
     print("以下のURLをクリックし、Google認証後に表示される文字列をコピーし、")
     print(auth_url)
     time.sleep(4)
     code = input("右の入力欄に貼り付けてエンターを押してください →")
-    flow.fetch_token(code=code)
-    return flow.credentials
+    auth_flow.fetch_token(code=code)
+    return auth_flow.credentials
 
 
 def get_client_secrets_type(client_config):
@@ -7,13 +7,15 @@ import logging
 import pandas as pd
 
 from google.oauth2.credentials import Credentials
-from google.oauth2 import service_account
 from google.auth.exceptions import RefreshError
-from gspread_dataframe import set_with_dataframe
-import gspread
 
 from . import errors, utils
 
+# heavy client libraries are imported when Google Sheets is first used
+gspread = utils.lazy_import('gspread')
+gspread_dataframe = utils.lazy_import('gspread_dataframe')
+service_account = utils.lazy_import('google.oauth2.service_account')
+
 LOGGER = logging.getLogger(__name__)
 
 
@@ -28,8 +30,8 @@ class MegatonGS(object):
     def __init__(self, credentials: Credentials, url: Optional[str] = None):
         """constructor"""
         self.credentials = credentials
-        self._client: gspread.client.Client = None
-        self._driver: gspread.spreadsheet.Spreadsheet = None
+        self._client: 'gspread.client.Client' = None
+        self._driver: 'gspread.spreadsheet.Spreadsheet' = None
         self.sheet = self.Sheet(self)
 
         self._authorize()
@@ -98,7 +100,7 @@ class MegatonGS(object):
         def __init__(self, parent):
             """constructor"""
             self.parent = parent
-            self._driver: gspread.worksheet.Worksheet = None
+            self._driver: 'gspread.worksheet.Worksheet' = None
             self.cell = self.Cell(self)
 
         def _refresh(self):
@@ -227,7 +229,7 @@ class MegatonGS(object):
                     elif 'PERMISSION_DENIED' in str(e):
                         raise errors.BadPermission
 
-                set_with_dataframe(
+                gspread_dataframe.set_with_dataframe(
                     self._driver,
                     df,
                     include_index=include_index,
@@ -245,7 +247,7 @@ class MegatonGS(object):
                     self._driver.add_rows(next_row + new_rows - current_row)
                     self._refresh()
 
-                set_with_dataframe(
+                gspread_dataframe.set_with_dataframe(
                     self._driver,
                     df,
                     include_index=include_index,
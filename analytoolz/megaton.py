@@ -1,28 +1,30 @@
 """Megaton GA"""
 
 from collections import defaultdict
-from ipywidgets import interact
-from IPython.display import clear_output
+import numpy as np
 import pandas as pd
 import sys
 
-from google.api_core.exceptions import ServiceUnavailable
-
-try:
-    import itables
+from . import constants, errors, ga3, ga4, google_api, gsheet, utils, widget
 
-    itables.init_notebook_mode()
-except:
-    if 'google.colab' in sys.modules:
-        from . import colabo
+# notebook and client libraries are imported when they are first used
+api_exceptions = utils.lazy_import('google.api_core.exceptions')
+colabo = utils.lazy_import(f"{__package__}.colabo")
 
-from . import constants, errors, ga3, ga4, google_api, gsheet, utils, widget
+# アカウントの次のページを読み込むメニュー項目
+MORE_ACCOUNTS = ('（さらに読み込む）', '__more__')
 
 
 class Launch(object):
-    def __init__(self, json):
-        """constructor"""
+    def __init__(self, json, cache_dir: str = None):
+        """constructor
+
+        Args:
+            json: path to the client secret or service account json file
+            cache_dir: directory to keep account and property summaries across sessions
+        """
         self.json = json
+        self.cache_dir = cache_dir
         self.creds = None
         self.ga_ver = None
         self.ga3 = None
@@ -30,6 +32,7 @@ class Launch(object):
         self.gs = None
         self.is_colab = False
         self.content_analysis = None
+        self._itables_ready = False
         if 'google.colab' in sys.modules:
             self.is_colab = True
             colabo.init()
@@ -40,8 +43,8 @@ class Launch(object):
         """GCS認証"""
         self.creds = google_api.get_credentials(self.json, constants.DEFAULT_SCOPES)
         try:
-            self.ga4 = ga4.MegatonGA4(self.creds)
-        except ServiceUnavailable:
+            self.ga4 = ga4.MegatonGA4(self.creds, cache_dir=self.cache_dir)
+        except api_exceptions.ServiceUnavailable:
             if 'invalid_grant' in str(sys.exc_info()[1]):
                 print(f"期限が切れたようなので、もう一度認証します。")
                 self.creds = google_api.get_credentials(self.json, constants.DEFAULT_SCOPES, reset_cache=True)
@@ -55,13 +58,20 @@ class Launch(object):
             return colabo.table(df)
         if type(df) == pd.core.frame.DataFrame:
             try:
-                itables.show(df)
-            except NameError:
+                import itables
+            except ImportError:
+                from IPython.display import display
                 display(df)
+            else:
+                if not self._itables_ready:
+                    itables.init_notebook_mode()
+                    self._itables_ready = True
+                itables.show(df)
 
     @staticmethod
     def clear():
         """Clear output of a Jupyter Notebook cell"""
+        from IPython.display import clear_output
         clear_output()
 
     """Google Analytics
@@ -69,21 +79,33 @@ class Launch(object):
 
     def launch_ga4(self):
         """GA4の準備"""
-        self.ga4 = ga4.MegatonGA4(self.creds)
+        self.ga4 = ga4.MegatonGA4(self.creds, cache_dir=self.cache_dir)
         self.select_ga4_property()
 
     def select_ga4_property(self):
         """GA4のアカウントとプロパティをメニューで選択"""
-        clear_output()
-        if self.ga4.accounts:
+        from ipywidgets import interact
+
+        self.clear()
+        # 読み込み済みのページだけでメニューを作り、残りは選ばれたときに読み込む
+        if self.ga4.loaded_accounts:
             print("　　↓GA4のアカウントとプロパティを以下から選択してください")
-            menu1, menu2, _ = widget.create_ga_account_property_menu(self.ga4.accounts)
+            menu1, menu2, _ = widget.create_ga_account_property_menu(self.ga4.loaded_accounts)
+            if self.ga4.more_accounts:
+                menu1.options = list(menu1.options) + [MORE_ACCOUNTS]
 
             @interact(value=menu1)
             def menu1_selected(value):
-                if value:
+                if value == MORE_ACCOUNTS[1]:
+                    options = [o for o in menu1.options if o != MORE_ACCOUNTS]
+                    options += [(d['name'], d['id']) for d in self.ga4.load_more_accounts()]
+                    if self.ga4.more_accounts:
+                        options.append(MORE_ACCOUNTS)
+                    menu1.options = options
+                elif value:
                     self.ga4.account.select(value)
-                    prop = [d for d in self.ga4.accounts if d['id'] == value][0]['properties']
+                    self.ga4.account.prefetch()
+                    prop = [d for d in self.ga4.loaded_accounts if d['id'] == value][0]['properties']
                     menu2.options = [(n['name'], n['id']) for n in prop]
                 else:
                     self.ga4.account.select(None)
@@ -129,12 +151,15 @@ class Launch(object):
 
     def launch_ga(self):
         """GA (UA)の準備"""
-        self.ga3 = ga3.MegatonUA(self.creds, credential_cache_file=google_api.get_cache_filename_from_json(self.json))
+        self.ga3 = ga3.MegatonUA(self.creds, credential_cache_file=google_api.get_cache_filename_from_json(self.json),
+                                 cache_dir=self.cache_dir)
         self.select_ga3_view()
 
     def select_ga3_view(self):
         """GAのアカウントとプロパティとビューをメニューで選択"""
-        clear_output()
+        from ipywidgets import interact
+
+        self.clear()
         if self.ga3.accounts:
             print("　　↓GAのアカウントとプロパティを以下から選択してください")
             menu1, menu2, menu3 = widget.create_ga_account_property_menu(self.ga3.accounts)
@@ -288,9 +313,29 @@ class Launch(object):
             self.sheet_name = sheet_name
             self.data = {}
             self.conf = {}
+            self.client_ids = None
             if self.update():
                 self.show()
 
+        @staticmethod
+        def _to_int(series: pd.Series):
+            """セッション番号を整数に変換する。欠損値は0"""
+            return pd.to_numeric(series, errors='coerce').fillna(0).astype('int64')
+
+        @staticmethod
+        def _date_to_int(series: pd.Series):
+            """日付（dateまたはYYYYMMDD）をYYYYMMDDの整数に変換する。欠損値は0"""
+            return pd.to_numeric(series.astype(str).str.replace('-', '', regex=False),
+                                 errors='coerce').fillna(0).astype('int64')
+
+        def _per_client(self, values: pd.Series):
+            """clientIdをindexとする値を、cid（clientIdの整数コード）順の配列にする。値がないclientIdは0"""
+            positions = self.client_ids.get_indexer(values.index)
+            found = positions >= 0
+            result = np.zeros(len(self.client_ids), dtype=values.dtype)
+            result[positions[found]] = values.to_numpy()[found]
+            return result
+
         def _get_config(self):
             """設定をシートから読み込む"""
             # open Google Sheets
@@ -328,9 +373,14 @@ class Launch(object):
                 print("...データを抽出します")
                 _df = ga3.get_cid_date_page(self.parent.ga3, self.conf)
                 print(f"...{len(_df)}行のデータを抽出しました")
+                _df['date'] = self._date_to_int(_df['date'])
+                _df['sessionCount'] = self._to_int(_df['sessionCount'])
+                # clientIdを整数コード(cid)にして、以降の集計と突合はcidで行う
+                codes, self.client_ids = pd.factorize(_df['clientId'])
+                _df = _df.drop(columns=['clientId']).assign(cid=codes.astype('int32'))
 
                 # pageとcidでまとめる
-                df = _df.groupby(['page', 'clientId']).agg({
+                df = _df.groupby(['page', 'cid']).agg({
                     'date': 'min',  # 初めて閲覧した日（再訪問とCVの判定で使う）
                     'sessionCount': 'min',  # 初めて閲覧したセッション番号（CVの判定で使う）
                     'entrances': 'max',  # 入口になったことがあれば1
@@ -341,8 +391,8 @@ class Launch(object):
                     'sessionCount': 'first_session_count',
                 }).reset_index()
 
-                # 回遊を算出
-                df['kaiyu'] = df.apply(lambda x: 0 if x['sessions'] == 1 & x['exits'] == 1 else 1, axis=1)
+                # 回遊を算出：1セッションだけ閲覧してそのまま離脱した場合以外は回遊あり
+                df['kaiyu'] = (~((df['sessions'] == 1) & (df['exits'] == 1))).astype('int64')
                 print("...閲覧後の回遊の指標を算出しました")
                 return df
 
@@ -353,56 +403,54 @@ class Launch(object):
                 _df = ga3.get_last_returned_date(self.parent.ga3)
 
                 # 閲覧後の再訪問を追加
-                df = pd.merge(
-                    self.data['page_cid'].drop(['sessions', 'exits'], inplace=False, axis=1),
-                    _df,
-                    how='left',
-                    on='clientId')
-
-                df['returns'] = df.apply(
-                    lambda x: 1 if (x['last_visit_date'] != '') & (
-                            x['last_visit_date'] != x['first_visit_date']) else 0, axis=1)
+                df = self.data['page_cid'].drop(['sessions', 'exits'], inplace=False, axis=1)
+                last_visit_date = self._per_client(self._date_to_int(_df['last_visit_date']))[df['cid'].to_numpy()]
+                df['returns'] = ((last_visit_date > 0) & (last_visit_date != df['first_visit_date'])).astype('int64')
 
-                return df.drop(['last_visit_date'], inplace=False, axis=1)
+                return df
 
         def _add_cv_to_page_cid(self, cv_pages, cv_label: str = 'cv'):
             """対象page閲覧後に指定CVページに到達した人数を追加する"""
             if self.parent.ga_ver == 3:
                 # 元データ抽出：入口以外でCVページに到達したcidとdate
-                _df = ga3.get_no_entrance_cv_cid(self.parent.ga3, cv_pages)
+                _df = ga3.get_no_entrance_cv_cid(self.parent.ga3, cv_pages, conf=self.conf)
 
                 if len(_df):
                     # cidでまとめて最後にCVしたdateを算出
-                    df = _df[['clientId', 'date', 'sessionCount']].groupby(['clientId']).max()
-                    df.rename(columns={
-                        'date': f'last_{cv_label}_date',
-                        'sessionCount': f'last_{cv_label}_session_count',
-                    }, inplace=True)
+                    df = _df[['clientId', 'date', 'sessionCount']].assign(
+                        date=self._date_to_int(_df['date']),
+                        sessionCount=self._to_int(_df['sessionCount']),
+                    ).groupby(['clientId']).max()
 
                     # コンテンツ閲覧後のCVを判定
-                    df2 = pd.merge(self.data['page_cid'], df, how='left', on='clientId')
-
-                    def calc_new_col(row):
-                        if row[f'last_{cv_label}_date']:
-                            if int(row[f'last_{cv_label}_date']) > int(row['first_visit_date']):
-                                return 1
-                            elif row[f'last_{cv_label}_date'] == row['first_visit_date'] \
-                                    and row['first_session_count'] < row[f'last_{cv_label}_session_count']:
-                                return 1
-                        return 0
-
-                    df2[cv_label] = df2.fillna(0).apply(calc_new_col, axis=1)
-                    return df2.drop([f'last_{cv_label}_date', f'last_{cv_label}_session_count'], inplace=False, axis=1)
-                else:
                     df2 = self.data['page_cid']
-                    df2[cv_label] = 0
-                    return df2
+                    cid = df2['cid'].to_numpy()
+                    last_date = self._per_client(df['date'])[cid]
+                    last_session_count = self._per_client(df['sessionCount'])[cid]
+
+                    # 閲覧より後の日、または同じ日の後のセッションでCVしていれば1
+                    return df2.assign(**{cv_label: ((last_date > df2['first_visit_date']) | (
+                            (last_date == df2['first_visit_date'])
+                            & (df2['first_session_count'] < last_session_count))).astype('int64')})
+                else:
+                    return self.data['page_cid'].assign(**{cv_label: 0})
+
+        def _restore_columns(self, df):
+            """集計用に整数にした列を元の形に戻したDataFrameを返す
+            cidはclientIdに、初回閲覧日はYYYYMMDD、セッション番号は文字列に戻す"""
+            client_ids = np.asarray(self.client_ids)[df['cid'].to_numpy()]
+            df = df.drop(columns=['cid']).assign(
+                first_visit_date=df['first_visit_date'].astype(str),
+                first_session_count=df['first_session_count'].astype(str),
+            )
+            df.insert(1, 'clientId', client_ids)
+            return df
 
         def _group_by_page(self, df):
             """Page単位でまとめる"""
             if self.parent.ga_ver == 3:
                 d = {
-                    'clientId': 'nunique',
+                    'cid': 'nunique',
                     'entrances': 'sum',
                     'kaiyu': 'sum',
                     'returns': 'sum',
@@ -410,10 +458,10 @@ class Launch(object):
                 for i in self.conf['metrics']:
                     d[i] = 'sum'
 
-                _df = df.groupby('page').agg(d).reset_index().sort_values('clientId', ascending=False)
+                _df = df.groupby('page').agg(d).reset_index().sort_values('cid', ascending=False)
 
                 c = {
-                    'clientId': 'users',
+                    'cid': 'users',
                     'entrances': 'entry_users',
                     'kaiyu': 'kaiyu_users',
                     'returns': 'return_users',
@@ -461,6 +509,8 @@ class Launch(object):
             self.data['page'] = self._group_by_page(
                 self.data['page_cid'].drop(['first_visit_date', 'first_session_count'], inplace=False, axis=1)
             )
+            # 集計用に変換した列を元に戻す
+            self.data['page_cid'] = self._restore_columns(self.data['page_cid'])
 
             # タイトルを追加する
             self.data['page'] = self._add_title_to_page()
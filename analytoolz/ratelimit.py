@@ -0,0 +1,69 @@
+"""
+Rate limiting for API calls shared across threads
+"""
+
+from typing import Optional
+import threading
+import time
+
+_LIMITERS = {}
+_LIMITERS_LOCK = threading.Lock()
+
+
+class RateLimiter(object):
+    """Token bucket which lets through up to `rate` calls per second on average
+
+    Args:
+        rate (float): calls allowed per second
+        burst (int): calls allowed at once after an idle period. Defaults to rate.
+    """
+
+    def __init__(self, rate: float, burst: Optional[int] = None):
+        """constructor"""
+        self.rate = float(rate)
+        self.burst = burst or max(1, int(rate))
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens: int = 1):
+        """Block until the call is allowed"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+def get_limiter(name: str, rate: float, burst: Optional[int] = None):
+    """Return the limiter shared by all callers using the same name, creating it if needed"""
+    with _LIMITERS_LOCK:
+        if name not in _LIMITERS:
+            _LIMITERS[name] = RateLimiter(rate, burst)
+        return _LIMITERS[name]
+
+
+class Throttled(object):
+    """Client proxy which passes every API call through a rate limiter"""
+
+    def __init__(self, client, limiter: RateLimiter):
+        """constructor"""
+        self._client = client
+        self._limiter = limiter
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        # path helpers are local string operations
+        if not callable(attr) or name.startswith('_') or name.endswith('_path'):
+            return attr
+
+        def call(*args, **kwargs):
+            self._limiter.acquire()
+            return attr(*args, **kwargs)
+
+        return call
@@ -0,0 +1,155 @@
+"""
+Retry with backoff and deadlines for API calls
+"""
+
+from typing import Callable, Optional
+import logging
+import random
+import threading
+import time
+
+from . import errors, utils
+
+api_exceptions = utils.lazy_import('google.api_core.exceptions')
+
+LOGGER = logging.getLogger(__name__)
+
+# gRPC errors which may succeed when the same call is sent again
+RETRYABLE_GRPC_ERRORS = [
+    'ResourceExhausted',
+    'ServiceUnavailable',
+    'DeadlineExceeded',
+    'InternalServerError',
+    'Aborted',
+]
+
+
+def is_retryable_grpc_error(e: Exception) -> bool:
+    """Return True if the error from a gRPC client is temporary"""
+    if 'invalid_grant' in str(e):
+        # expired credentials are reported as ServiceUnavailable
+        return False
+    return isinstance(e, tuple(getattr(api_exceptions, n) for n in RETRYABLE_GRPC_ERRORS))
+
+
+# reasons of 403 errors from Google APIs which mean "slow down" rather than "forbidden"
+RATE_LIMIT_REASONS = ['rateLimitExceeded', 'userRateLimitExceeded', 'rate limit exceeded']
+
+
+def is_retryable_http_error(e: Exception) -> bool:
+    """Return True if the error from a Google API HTTP client is temporary"""
+    status = getattr(getattr(e, 'resp', None), 'status', None)
+    if status == 403:
+        content = getattr(e, 'content', b'')
+        content = content.decode('utf-8', 'replace') if isinstance(content, bytes) else str(content)
+        return any(r.lower() in content.lower() for r in RATE_LIMIT_REASONS)
+    return status in [429, 500, 502, 503, 504] or isinstance(e, (BrokenPipeError, ConnectionError, TimeoutError))
+
+
+class Deadline(object):
+    """Point in time after which no more calls should be started
+
+    Args:
+        seconds (float): seconds from now. The deadline never expires if None.
+    """
+
+    def __init__(self, seconds: Optional[float] = None):
+        """constructor"""
+        self.seconds = seconds
+        self.expires = time.monotonic() + seconds if seconds else None
+
+    @property
+    def remaining(self) -> Optional[float]:
+        """Seconds left until the deadline, or None if there is no deadline"""
+        if self.expires is None:
+            return None
+        return max(0.0, self.expires - time.monotonic())
+
+    @property
+    def expired(self) -> bool:
+        return self.expires is not None and time.monotonic() >= self.expires
+
+
+class RetryBudget(object):
+    """Number of retries shared by callers, so that a burst of failures does not turn into a retry storm
+
+    Args:
+        retries (int): retries allowed in total
+    """
+
+    def __init__(self, retries: int):
+        """constructor"""
+        self.retries = retries
+        self.used = 0
+        self._lock = threading.Lock()
+
+    @property
+    def remaining(self) -> int:
+        return max(0, self.retries - self.used)
+
+    def spend(self) -> bool:
+        """Take a retry from the budget. Returns False if none is left."""
+        with self._lock:
+            if self.used >= self.retries:
+                return False
+            self.used += 1
+            return True
+
+
+class RetryPolicy(object):
+    """Call a function again when it fails with a temporary error, waiting longer each time
+
+    Waits are chosen at random between 0 and an exponentially growing cap (full jitter)
+    so that concurrent callers do not retry at the same moment.
+
+    Args:
+        attempts (int): maximum number of calls including the first one
+        initial (float): cap of the first wait in seconds
+        maximum (float): largest cap of a wait in seconds
+        multiplier (float): growth of the cap after each failure
+        timeout (float): seconds to wait for each call. Passed to the function as `timeout`.
+        retryable (callable): returns True if an exception is worth retrying
+        budget (RetryBudget): retries shared with other policies. Copies of a policy share it.
+    """
+
+    def __init__(self, attempts: int = 5, initial: float = 1.0, maximum: float = 32.0, multiplier: float = 2.0,
+                 timeout: Optional[float] = None, retryable: Callable[[Exception], bool] = is_retryable_grpc_error,
+                 budget: Optional[RetryBudget] = None):
+        """constructor"""
+        self.attempts = attempts
+        self.initial = initial
+        self.maximum = maximum
+        self.multiplier = multiplier
+        self.timeout = timeout
+        self.retryable = retryable
+        self.budget = budget
+
+    def delay(self, attempt: int) -> float:
+        """Seconds to wait after the given number of failed attempts"""
+        cap = min(self.maximum, self.initial * self.multiplier ** (attempt - 1))
+        return random.uniform(0, cap)
+
+    def call(self, func: Callable, *args, deadline: Optional[Deadline] = None, **kwargs):
+        """Call the function, retrying temporary errors until attempts or the deadline run out"""
+        for attempt in range(1, self.attempts + 1):
+            if deadline and deadline.expired:
+                raise errors.DeadlineExceeded(f"Deadline of {deadline.seconds} seconds exceeded.")
+            timeout = self.timeout
+            if deadline and deadline.remaining is not None:
+                timeout = min(timeout, deadline.remaining) if timeout else deadline.remaining
+            if timeout:
+                kwargs['timeout'] = timeout
+
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                if not self.retryable(e) or attempt == self.attempts:
+                    raise
+                wait = self.delay(attempt)
+                if deadline and deadline.remaining is not None and deadline.remaining <= wait:
+                    raise
+                if self.budget and not self.budget.spend():
+                    LOGGER.warning(f"{type(e).__name__}: no retries left in the budget of {self.budget.retries}")
+                    raise
+                LOGGER.warning(f"{type(e).__name__}: retrying in {wait:.1f}s (attempt {attempt}/{self.attempts})")
+                time.sleep(wait)
@@ -0,0 +1,274 @@
+"""
+Headless runner for reports described in YAML or JSON job files
+
+A job file looks like this:
+
+    concurrency: 4            # reports to run at the same time
+    rate_limits:              # API calls per second
+      ga4: 10
+      ga3: 5
+    cache_dir: .cache         # shared cache for metadata and results
+    channel_options:          # gRPC channel settings (see transport.ChannelOptions)
+      compression: gzip
+      timeout: 300
+    defaults:
+      date_window: {days: 7, offset: 1}
+    jobs:
+      - name: events
+        source: ga4
+        property: "123456789"
+        dimensions: [date, eventName]
+        metrics: [eventCount]
+        dimension_filter: eventName==page_view
+        output: {type: parquet, path: out/events.parquet}
+      - name: pages
+        source: ga3
+        view: "987654"
+        dimensions: [pagePath]
+        metrics: [pageviews]
+        start_date: '2022-01-01'
+        end_date: '2022-01-31'
+        output: {type: sheets, url: 'https://docs.google.com/...', sheet: pages, mode: w}
+
+Run it from the command line:
+
+    python -m analytoolz.runner jobs.yaml --credentials service_account.json
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from typing import Optional
+import argparse
+import hashlib
+import json
+import logging
+import os
+import sys
+import threading
+
+from . import bq, cache, constants, errors, ga3, ga4, google_api, gsheet, ratelimit, transport, utils
+
+yaml = utils.lazy_import('yaml')
+
+LOGGER = logging.getLogger(__name__)
+
+SOURCES = {
+    'ga4': ('property', ga4.MegatonGA4),
+    'ga3': ('view', ga3.MegatonUA),
+}
+
+
+def load_jobs(path: str):
+    """Read a job file in YAML or JSON format"""
+    with open(path, 'r') as f:
+        if os.path.splitext(path)[1].lower() in ['.yaml', '.yml']:
+            spec = yaml.safe_load(f)
+        else:
+            spec = json.load(f)
+    if isinstance(spec, list):
+        spec = {'jobs': spec}
+    return spec
+
+
+def get_dates(job: dict):
+    """Return start and end dates of a job
+
+    date_window: {days: N, offset: K} covers N days ending K days before today.
+    Otherwise start_date and end_date are used. Relative dates such as 'yesterday' are resolved
+    to YYYY-MM-DD, so that a cached result is only reused for the same dates.
+    """
+    window = job.get('date_window')
+    if window:
+        end = date.today() - timedelta(days=window.get('offset', 1))
+        start = end - timedelta(days=window.get('days', 7) - 1)
+        return start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d')
+    start, end = job.get('start_date', '7daysAgo'), job.get('end_date', 'yesterday')
+    return utils.resolve_date(start).strftime('%Y-%m-%d'), utils.resolve_date(end).strftime('%Y-%m-%d')
+
+
+class Runner(object):
+    """Run report jobs without widgets using a shared concurrency budget, rate limits and cache
+
+    Args:
+        credentials: credentials to access APIs
+        concurrency (int): number of jobs to run at the same time
+        rate_limits (dict): API calls per second for each source ('ga4', 'ga3')
+        cache_dir (str): directory of the cache shared by all jobs
+        cache_ttl (int): seconds until cached metadata and results expire
+        channel_options (dict): arguments of transport.ChannelOptions for API clients
+    """
+
+    def __init__(self, credentials, concurrency: int = 4, rate_limits: Optional[dict] = None,
+                 cache_dir: Optional[str] = None, cache_ttl: int = 3600, channel_options: Optional[dict] = None):
+        """constructor"""
+        self.credentials = credentials
+        self.channel_options = transport.ChannelOptions(**channel_options) if channel_options else None
+        self.concurrency = concurrency
+        self.rate_limits = rate_limits or {}
+        self.cache = cache.DiskCache(cache_dir, ttl=cache_ttl)
+        self._local = threading.local()
+        self._clients = {}
+        self._key_locks = {}
+        self._lock = threading.Lock()
+
+    def _get_megaton(self, source: str):
+        """Return a Megaton instance for the current thread
+
+        API clients are thread-safe and shared by all threads.
+        """
+        instances = self._local.__dict__.setdefault('instances', {})
+        if source not in instances:
+            _, cls = SOURCES[source]
+            limiter = None
+            if self.rate_limits.get(source):
+                limiter = ratelimit.get_limiter(f"runner:{source}", self.rate_limits[source])
+            megaton = cls(None, rate_limiter=limiter, channel_options=self.channel_options)
+            megaton.credentials = self.credentials
+            megaton.cache = self.cache
+            with self._lock:
+                if source in self._clients:
+                    megaton.data_client, megaton.admin_client = self._clients[source]
+                else:
+                    megaton.build_client()
+                    self._clients[source] = (megaton.data_client, megaton.admin_client)
+            instances[source] = megaton
+        return instances[source]
+
+    def _fetch(self, job: dict):
+        """Get report data for a job"""
+        source = job.get('source', 'ga4')
+        if source not in SOURCES:
+            raise errors.BadRequest(f"Unknown source: {source}")
+        id_key, _ = SOURCES[source]
+        if not job.get(id_key):
+            raise errors.BadRequest(f"'{id_key}' is required for {source} jobs.")
+
+        start_date, end_date = get_dates(job)
+        kwargs = {
+            'start_date': start_date,
+            'end_date': end_date,
+            'dimension_filter': job.get('dimension_filter'),
+            'metric_filter': job.get('metric_filter'),
+            'order_bys': job.get('order_bys'),
+            'limit': job.get('limit', 10000),
+        }
+        if source == 'ga3':
+            kwargs['segments'] = job.get('segments')
+
+        # every argument of the request is in the key
+        key = json.dumps([source, str(job[id_key]), job['dimensions'], job['metrics'], kwargs], sort_keys=True)
+        key = 'result:' + hashlib.sha1(key.encode('utf-8')).hexdigest()
+        # jobs requesting the same report wait for the first one instead of calling API again
+        with self._lock:
+            entry = self._key_locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                df = self.cache.get(key)
+                if df is not None:
+                    LOGGER.info(f"[{job['name']}] using cached result")
+                    return df
+                return self.cache.set(key, self._request(source, job, str(job[id_key]), **kwargs))
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._key_locks[key]
+
+    def _request(self, source: str, job: dict, id: str, **kwargs):
+        """Call API for a job"""
+        megaton = self._get_megaton(source)
+        if source == 'ga4':
+            megaton.property.select(None)
+            megaton.property.id = id
+            megaton.property.get_available()
+            return megaton.report.run(job['dimensions'], job['metrics'], **kwargs)
+        else:
+            megaton.view.id = id
+            return megaton.report.show(job['dimensions'], job['metrics'], **kwargs)
+
+    def _write(self, df, output: dict):
+        """Write data to the output sink"""
+        kind = output.get('type', 'parquet')
+        mode = output.get('mode', 'w')
+        if output.get('path'):
+            os.makedirs(os.path.dirname(os.path.abspath(output['path'])), exist_ok=True)
+        if kind == 'parquet':
+            df.to_parquet(output['path'], index=False, partition_cols=output.get('partition_cols'))
+        elif kind == 'csv':
+            utils.save_df(df, output['path'])
+        elif kind == 'bigquery':
+            bq.Megaton(self.credentials, output['project']).load_dataframe(df, output['table'], mode=mode)
+        elif kind == 'sheets':
+            gs = gsheet.MegatonGS(self.credentials, output['url'])
+            gs.sheet.select(output['sheet'])
+            gs.sheet.save_data(df, mode=mode)
+        else:
+            raise errors.BadRequest(f"Unknown output type: {kind}")
+        return output.get('path') or output.get('table') or output.get('url')
+
+    def run_job(self, job: dict):
+        """Run a single job and write the result"""
+        LOGGER.info(f"[{job['name']}] started")
+        df = self._fetch(job)
+        if df is None or not len(df):
+            LOGGER.warning(f"[{job['name']}] no data found.")
+            return {'name': job['name'], 'rows': 0, 'output': None}
+        output = self._write(df, job['output']) if job.get('output') else None
+        LOGGER.info(f"[{job['name']}] {len(df)} rows written to {output}")
+        return {'name': job['name'], 'rows': len(df), 'output': output}
+
+    def _run_job_safely(self, job: dict):
+        try:
+            return dict(self.run_job(job), error=None)
+        except Exception as e:
+            LOGGER.exception(f"[{job['name']}] failed")
+            return {'name': job['name'], 'rows': 0, 'output': None, 'error': repr(e)}
+
+    def run(self, jobs: list, defaults: Optional[dict] = None):
+        """Run jobs in parallel
+        Args:
+            jobs (list): job definitions
+            defaults (dict): values used when a job does not define them
+        Returns:
+            list of dict with name, rows, output and error of each job
+        """
+        jobs = [dict(defaults or {}, **j) for j in jobs]
+        for i, job in enumerate(jobs):
+            job.setdefault('name', f"job{i + 1}")
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            return list(executor.map(self._run_job_safely, jobs))
+
+
+def run_file(path: str, credentials, **kwargs):
+    """Run all jobs in a job file. Keyword arguments override settings in the file."""
+    spec = load_jobs(path)
+    settings = {k: spec[k] for k in ['concurrency', 'rate_limits', 'cache_dir', 'cache_ttl', 'channel_options']
+                if k in spec}
+    settings.update({k: v for k, v in kwargs.items() if v is not None})
+    runner = Runner(credentials, **settings)
+    return runner.run(spec.get('jobs', []), spec.get('defaults'))
+
+
+def main(argv: Optional[list] = None):
+    parser = argparse.ArgumentParser(description="Run GA/GA4 report jobs described in a YAML or JSON file.")
+    parser.add_argument('job_file')
+    parser.add_argument('--credentials', required=True, help="client secret or service account json file")
+    parser.add_argument('--concurrency', type=int)
+    parser.add_argument('--cache-dir')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        format="%(asctime)s %(levelname)s %(message)s")
+    credentials = google_api.get_credentials(args.credentials, constants.DEFAULT_SCOPES)
+    results = run_file(args.job_file, credentials, concurrency=args.concurrency, cache_dir=args.cache_dir)
+    failed = [r for r in results if r['error']]
+    for r in results:
+        status = f"failed: {r['error']}" if r['error'] else f"{r['rows']} rows -> {r['output']}"
+        print(f"{r['name']}: {status}")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,163 @@
+"""
+Write report data to a Parquet dataset in chunks within a memory budget
+"""
+
+from typing import Callable, Iterable, Optional
+import logging
+import os
+import sys
+
+from . import errors, utils
+
+pa = utils.lazy_import('pyarrow')
+pq = utils.lazy_import('pyarrow.parquet')
+ds = utils.lazy_import('pyarrow.dataset')
+pd = utils.lazy_import('pandas')
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_MEMORY_BUDGET = 256 * 1024 * 1024
+
+
+def _estimate_row_size(rows: list) -> int:
+    """Approximate bytes used by a row in a Python list"""
+    sample = rows[:100]
+    total = sum(sys.getsizeof(r) + sum(sys.getsizeof(v) for v in r) for r in sample)
+    return max(1, total // len(sample))
+
+
+class ParquetSpill(object):
+    """Keep rows in memory up to a budget, then write them to a Parquet dataset as a row group
+
+    Args:
+        path (str): directory of the dataset. Created if missing. It must be empty unless overwrite is set.
+        columns (list): column names. Can be set later before the first flush.
+        memory_budget (int): bytes of rows to keep in memory before writing them
+        partition_cols (list): columns to partition the dataset by (col=value subdirectories)
+        convert (callable): function applied to each chunk as a DataFrame before writing
+        overwrite (bool): write into a directory that already has files. Parquet part files in it
+            (from an earlier run) are removed; other files are left as they are.
+    """
+
+    def __init__(self, path: str, columns: Optional[list] = None, memory_budget: Optional[int] = None,
+                 partition_cols: Optional[list] = None, convert: Optional[Callable] = None,
+                 overwrite: bool = False):
+        """constructor"""
+        os.makedirs(path, exist_ok=True)
+        if os.listdir(path) and not overwrite:
+            raise errors.BadRequest(f"{path} is not empty. Set overwrite=True to write into it.")
+        self.path = path
+        self.columns = columns
+        self.memory_budget = memory_budget or DEFAULT_MEMORY_BUDGET
+        self.partition_cols = partition_cols
+        self.convert = convert
+        self.rows = 0
+        self.schema = None
+        self._buffer = []
+        self._buffer_limit = None
+        self._frames = []
+        self._frames_size = 0
+        self._writer = None
+        self._chunks = 0
+        self._files = []
+        if overwrite:
+            self._remove(self._find_parts())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _find_parts(self) -> list:
+        """Return Parquet part files under the directory, as written by a ParquetSpill"""
+        found = []
+        for root, _, files in os.walk(self.path):
+            found += [os.path.join(root, f) for f in files if f.startswith('part-') and f.endswith('.parquet')]
+        return found
+
+    def _remove(self, files: list):
+        """Delete the files and partition directories left empty by it"""
+        for file in files:
+            if os.path.isfile(file):
+                os.remove(file)
+            directory = os.path.dirname(file)
+            while os.path.abspath(directory) != os.path.abspath(self.path) and os.path.isdir(directory) \
+                    and not os.listdir(directory):
+                os.rmdir(directory)
+                directory = os.path.dirname(directory)
+
+    def clear(self):
+        """Delete the files written by this writer so far"""
+        if self._writer:
+            self._writer.close()
+            self._writer = None
+        self._remove(self._files)
+        self._files = []
+        self._buffer, self._frames, self._frames_size = [], [], 0
+        self.rows, self._chunks, self.schema = 0, 0, None
+
+    def append(self, rows: Iterable):
+        """Add rows and write them out when the buffer exceeds the memory budget"""
+        self._buffer.extend(rows)
+        if self._buffer and self._buffer_limit is None:
+            self._buffer_limit = max(1000, self.memory_budget // _estimate_row_size(self._buffer))
+            LOGGER.debug(f"writing every {self._buffer_limit} rows")
+        if self._buffer_limit and len(self._buffer) >= self._buffer_limit:
+            self.flush()
+
+    def append_df(self, df: 'pd.DataFrame'):
+        """Add a DataFrame and write it out with earlier ones when they exceed the memory budget"""
+        if len(df):
+            self._frames.append(df)
+            self._frames_size += int(df.memory_usage(deep=True).sum())
+            if self._frames_size >= self.memory_budget:
+                self.flush()
+
+    def flush(self):
+        """Write rows in the buffer"""
+        if self._buffer:
+            df = pd.DataFrame(self._buffer, columns=self.columns)
+            self._buffer = []
+            self._write(df)
+        if self._frames:
+            df = pd.concat(self._frames, ignore_index=True)
+            self._frames, self._frames_size = [], 0
+            self._write(df)
+
+    def _write(self, df: 'pd.DataFrame'):
+        if self.convert:
+            df = self.convert(df)
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        if self.schema is None:
+            self.schema = table.schema
+        elif table.schema != self.schema:
+            table = table.cast(self.schema)
+
+        if self.partition_cols:
+            pq.write_to_dataset(table, self.path, partition_cols=self.partition_cols,
+                                basename_template=f"part-{self._chunks}-{{i}}.parquet",
+                                file_visitor=lambda f: self._files.append(f.path))
+        else:
+            if not self._writer:
+                file = os.path.join(self.path, 'part-0.parquet')
+                self._writer = pq.ParquetWriter(file, self.schema)
+                self._files.append(file)
+            self._writer.write_table(table)
+        self._chunks += 1
+        self.rows += len(df)
+        LOGGER.debug(f"{self.rows} rows written to {self.path}")
+
+    def close(self):
+        """Write the rest of rows and return the dataset to read lazily"""
+        self.flush()
+        if self._writer:
+            self._writer.close()
+            self._writer = None
+        return self.dataset()
+
+    def dataset(self):
+        """Return the written data as pyarrow.dataset.Dataset"""
+        # only the files of this writer, as the directory may have others when overwrite is set
+        return ds.dataset(self._files, format='parquet', partitioning='hive' if self.partition_cols else None,
+                          partition_base_dir=self.path)
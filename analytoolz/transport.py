@@ -0,0 +1,91 @@
+"""
+Settings of gRPC channels for API clients
+"""
+
+from typing import Optional
+import itertools
+import threading
+
+from . import utils
+
+grpc = utils.lazy_import('grpc')
+
+
+class ChannelOptions(object):
+    """Options applied to every gRPC channel built for API clients
+
+    Args:
+        compression (str): 'gzip' or 'deflate' to compress messages. Requests are compressed
+            and the server is told that compressed responses are accepted.
+        max_receive_message_length (int): largest response in bytes. -1 for unlimited.
+        keepalive_time (int): seconds between keepalive pings while a call is waiting for a response.
+            Keeps long report calls alive through proxies and NAT which drop idle connections.
+        keepalive_timeout (int): seconds to wait for a keepalive ping to be acknowledged
+        timeout (float): seconds to wait for each call
+        pool_size (int): number of channels to spread calls over
+    """
+
+    def __init__(self, compression: Optional[str] = 'gzip', max_receive_message_length: int = -1,
+                 keepalive_time: Optional[int] = None, keepalive_timeout: int = 20,
+                 timeout: Optional[float] = None, pool_size: int = 1):
+        """constructor"""
+        self.compression = compression
+        self.max_receive_message_length = max_receive_message_length
+        self.keepalive_time = keepalive_time
+        self.keepalive_timeout = keepalive_timeout
+        self.timeout = timeout
+        self.pool_size = max(1, pool_size)
+
+    def grpc_options(self) -> list:
+        """Return channel arguments for grpc"""
+        options = [
+            ('grpc.max_send_message_length', -1),
+            ('grpc.max_receive_message_length', self.max_receive_message_length),
+        ]
+        if self.keepalive_time:
+            options += [
+                ('grpc.keepalive_time_ms', self.keepalive_time * 1000),
+                ('grpc.keepalive_timeout_ms', self.keepalive_timeout * 1000),
+                ('grpc.http2.max_pings_without_data', 0),
+            ]
+        if self.pool_size > 1:
+            # keep channels separate instead of sharing a subchannel
+            options.append(('grpc.use_local_subchannel_pool', 1))
+        return options
+
+    def grpc_compression(self):
+        if self.compression == 'gzip':
+            return grpc.Compression.Gzip
+        elif self.compression == 'deflate':
+            return grpc.Compression.Deflate
+        return grpc.Compression.NoCompression
+
+    def build_client(self, client_class, credentials):
+        """Build a GAPIC client, or a pool of them, using channels with these options"""
+        clients = []
+        for _ in range(self.pool_size):
+            transport_class = client_class.get_transport_class('grpc')
+            channel = transport_class.create_channel(
+                credentials=credentials,
+                options=self.grpc_options(),
+                compression=self.grpc_compression(),
+            )
+            clients.append(client_class(transport=transport_class(channel=channel)))
+        if len(clients) == 1:
+            return clients[0]
+        return ClientPool(clients)
+
+
+class ClientPool(object):
+    """Client proxy which sends each call through the next client in turn"""
+
+    def __init__(self, clients: list):
+        """constructor"""
+        self._clients = clients
+        self._cycle = itertools.cycle(clients)
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        with self._lock:
+            client = next(self._cycle)
+        return getattr(client, name)
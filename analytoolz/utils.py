@@ -2,9 +2,39 @@
 Common Functions
 """
 
+from datetime import date, datetime, timedelta
+import importlib
 import os
 import pandas as pd
 import re
+import sys
+import types
+
+
+class LazyModule(types.ModuleType):
+    """Module proxy which imports the real module when one of its attributes is first used"""
+
+    def __init__(self, name: str):
+        super().__init__(name)
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            self._module = importlib.import_module(self.__name__)
+        return self._module
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def __dir__(self):
+        return dir(self._load())
+
+
+def lazy_import(name: str):
+    """Return a module which is imported on first use to keep package import fast"""
+    if name in sys.modules:
+        return sys.modules[name]
+    return LazyModule(name)
 
 
 def is_integer(n):
@@ -73,6 +103,31 @@ def get_date_range(start_date: str, end_date: str, format: str = None):
     return [d.strftime(format) for d in date_range]
 
 
+def resolve_date(value: str) -> date:
+    """Convert a date of Analytics APIs such as 'yesterday', '7daysAgo' or '2022-01-31' to date"""
+    value = str(value).strip()
+    if value == 'today':
+        return date.today()
+    elif value == 'yesterday':
+        return date.today() - timedelta(days=1)
+    elif re.match(r'^\d+daysAgo$', value):
+        return date.today() - timedelta(days=int(value[:-7]))
+    return datetime.strptime(value.replace('-', ''), '%Y%m%d').date()
+
+
+def split_date_range(start_date: str, end_date: str, parts: int = 2):
+    """Split a date range into up to `parts` ranges of nearly equal days in YYYY-MM-DD format"""
+    start, end = resolve_date(start_date), resolve_date(end_date)
+    days = (end - start).days + 1
+    parts = max(1, min(parts, days))
+    ranges = []
+    for i in range(parts):
+        s = start + timedelta(days=days * i // parts)
+        e = start + timedelta(days=days * (i + 1) // parts - 1)
+        ranges.append((s.strftime('%Y-%m-%d'), e.strftime('%Y-%m-%d')))
+    return ranges
+
+
 def get_chunked_list(original_list: list, chunk_size: int = 100):
     """Split a list into chunks"""
     chunked_list = []
@@ -2,13 +2,14 @@
 Functions for widgets (forms)
 """
 
-from ipywidgets import Dropdown
 from typing import List, Tuple
 
 
 def dropdown_menu(label: str, default: str, option_list: List[Tuple[str, str]] = []):
     """Create a drop-down menu
     """
+    from ipywidgets import Dropdown
+
     # set label
     options = [(default, '')]
     if option_list:
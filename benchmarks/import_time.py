@@ -0,0 +1,81 @@
+"""
+Startup-time benchmark for analytoolz
+
+Imports each module in a fresh interpreter and reports the wall-clock time
+together with the heavy dependencies that were loaded as a side effect.
+
+    python benchmarks/import_time.py [-n REPEAT] [module ...]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_MODULES = [
+    'analytoolz.megaton',
+    'analytoolz.ga4',
+    'analytoolz.ga3',
+    'analytoolz.bq',
+    'analytoolz.gsheet',
+]
+
+# modules that should only be loaded when the subsystem using them is used
+HEAVY_MODULES = [
+    'IPython.display',
+    'ipywidgets',
+    'itables',
+    'panel',
+    'googleapiclient.discovery',
+    'google_auth_oauthlib.flow',
+    'google.analytics.admin_v1alpha',
+    'google.analytics.data_v1beta',
+    'google.api_core.exceptions',
+    'google.cloud.bigquery',
+    'google.cloud.bigquery_datatransfer',
+    'grpc',
+    'gspread',
+]
+
+SCRIPT = """
+import json, sys, time
+t = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - t
+print(json.dumps({{'seconds': elapsed, 'loaded': [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+
+def measure(module: str):
+    """Import a module in a new interpreter and return the result"""
+    code = SCRIPT.format(module=module, heavy=HEAVY_MODULES)
+    out = subprocess.run([sys.executable, '-c', code], cwd=ROOT, capture_output=True, text=True)
+    if out.returncode:
+        raise RuntimeError(out.stderr.strip().splitlines()[-1])
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('modules', nargs='*', default=DEFAULT_MODULES)
+    parser.add_argument('-n', '--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'module':<24} {'median':>9} {'min':>9}  heavy modules loaded")
+    for module in args.modules:
+        try:
+            results = [measure(module) for _ in range(args.repeat)]
+        except RuntimeError as e:
+            print(f"{module:<24} failed: {e}")
+            continue
+        times = [r['seconds'] for r in results]
+        loaded = ', '.join(results[-1]['loaded']) or '-'
+        print(f"{module:<24} {statistics.median(times):>8.3f}s {min(times):>8.3f}s  {loaded}")
+
+
+if __name__ == '__main__':
+    main()